@@ -1,11 +1,20 @@
-from fastapi import FastAPI, HTTPException
+from anyio import to_thread
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
-from storage import storage
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import Any, Optional
+from storage import get_storage
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from cachetools import TTLCache
 from langchain.agents import create_agent
 from langchain_ollama import ChatOllama
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+import asyncio
+import httpx
+import msgspec
+import orjson
+import os
+import time
 
 system_prompt = """Eres un asistente de domótica que controla habitaciones y dispositivos.
 
@@ -14,48 +23,8 @@ REGLAS CRÍTICAS PARA USO DE HERRAMIENTAS:
 1. SIEMPRE proporciona TODOS los parámetros requeridos por cada herramienta
 2. NUNCA inventes parámetros que no existen en la herramienta
 3. Lee CUIDADOSAMENTE la descripción de cada herramienta antes de usarla
-
-HERRAMIENTAS DE HABITACIONES:
-- agregar_habitacion(room_type: str) → Tipos: "comedor", "cocina", "baño", "living", "dormitorio"
-- consultar_habitaciones() → Sin parámetros
-- consultar_habitacion(room_name: str)
-- modificar_habitacion(old_name: str, new_name: str)
-- eliminar_habitacion(room_name: str)
-
-HERRAMIENTAS DE DISPOSITIVOS:
-- agregar_dispositivo(room_name: str, device_type: str, initial_state: Optional[str])
-  * device_type: "light", "thermostat", "fan", "oven"
-  * initial_state: "true"/"false" para luz, "0-5" para ventilador, "16-32" para termostato
-  
-- consultar_dispositivos(room_name: Optional[str])
-- consultar_dispositivo(device_id: str)
-- modificar_dispositivo(device_id: str, room: Optional[str], state: Optional[str])
-- eliminar_dispositivo(device_id: str)
-
-CONTROL DE LUCES:
-- alternar_luz(device_id: str)
-- encender_luz(device_id: str)
-- apagar_luz(device_id: str)
-
-CONTROL DE TERMOSTATOS:
-- ajustar_termostato(device_id: str, temperature: int) → Rango: 16-32°C
-- subir_temperatura(device_id: str, grados: int = 1)
-- bajar_temperatura(device_id: str, grados: int = 1)
-
-CONTROL DE VENTILADORES:
-- ajustar_ventilador(device_id: str, speed: int) → Rango: 0-5
-- apagar_ventilador(device_id: str)
-
-CONTROL DE HORNOS:
-- ajustar_horno(device_id: str, temperature: Optional[int], timer: Optional[int], active: Optional[bool])
-- encender_horno(device_id: str)
-- apagar_horno(device_id: str)
-- configurar_temporizador_horno(device_id: str, minutos: int)
-
-EJEMPLOS DE USO CORRECTO:
-✓ agregar_dispositivo(room_name="cocina", device_type="light", initial_state="false")
-✓ ajustar_termostato(device_id="thermo-01", temperature=22)
-✓ agregar_habitacion(room_type="dormitorio")
+4. Los IDs de dispositivos tienen la forma "light-01", "thermo-01", "fan-01", "oven-01"
+5. Si no conoces un nombre o ID, consúltalo primero con las herramientas de consulta
 
 ERRORES COMUNES A EVITAR:
 ✗ agregar_dispositivo(device_id="light-01") → Faltan room_name y device_type
@@ -64,14 +33,147 @@ ERRORES COMUNES A EVITAR:
 
 Responde de forma natural pero USA LAS HERRAMIENTAS CORRECTAMENTE."""
 
+# Tamaño del threadpool de anyio para los endpoints síncronos
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "200"))
+
+# Prompt del modelo pequeño: mismo comportamiento, pero puede derivar al grande
+ESCALATION_TOKEN = "[ESCALAR]"
+small_system_prompt = system_prompt + f"""
+
+Si la petición requiere un razonamiento complejo que no puedes resolver con
+las herramientas, responde ÚNICAMENTE con {ESCALATION_TOKEN} y nada más."""
+
+# Configuración compartida por ambos modelos: mismo servidor Ollama y mismo
+# pool de conexiones keep-alive (las peticiones de /chat concurrentes
+# reutilizan sockets en lugar de abrir uno nuevo por llamada)
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "1h")
+OLLAMA_CLIENT_KWARGS = {
+    "timeout": httpx.Timeout(600.0, connect=5.0),
+    "limits": httpx.Limits(max_connections=64, max_keepalive_connections=32)
+}
+
+# Transporte MCP: "stdio" lanza los servidores como subprocesos de cada worker;
+# "http" se conecta a servidores ya en ejecución (compartidos entre workers),
+# iniciados con MCP_TRANSPORT=http uv run servers/mcp_*.py
+MCP_TRANSPORT = os.getenv("MCP_TRANSPORT", "stdio")
+MCP_HOST = os.getenv("MCP_HOST", "127.0.0.1")
+# "split": un servidor por dominio; "combined": servers/mcp_all.py con ambos
+# dominios en un único proceso (una sola copia de storage)
+MCP_SERVERS = os.getenv("MCP_SERVERS", "split")
+
+# Se construyen en lifespan: importar este módulo no abre conexiones ni procesos
+model: Optional[ChatOllama] = None
+small_model: Optional[ChatOllama] = None
+client: Optional[MultiServerMCPClient] = None
+tools = None
+agent = None
+agent_small = None
+
+def _build_models() -> tuple[ChatOllama, Optional[ChatOllama]]:
+    """Crea el modelo grande y, si se configuró OLLAMA_SMALL_MODEL, el pequeño."""
+    # Modelo grande: síntesis y razonamiento complejo
+    large = ChatOllama(
+        model=os.getenv("OLLAMA_MODEL", "gpt-oss:120b-cloud"),
+        base_url=OLLAMA_BASE_URL,
+        # Mantener el modelo cargado entre peticiones para reutilizar la caché KV
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        client_kwargs=OLLAMA_CLIENT_KWARGS
+    )
+    # Modelo pequeño (opcional): selección y ejecución de herramientas en el caso
+    # común. Sin él, todas las peticiones van directamente al modelo grande
+    small_name = os.getenv("OLLAMA_SMALL_MODEL")
+    if not small_name:
+        return large, None
+    small = ChatOllama(
+        model=small_name,
+        base_url=OLLAMA_BASE_URL,
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        client_kwargs=OLLAMA_CLIENT_KWARGS
+    )
+    return large, small
+
+def _mcp_connection(script: str, port: int) -> dict:
+    """Configuración de conexión a un servidor MCP según el transporte elegido."""
+    if MCP_TRANSPORT == "http":
+        return {
+            "transport": "streamable_http",
+            "url": f"http://{MCP_HOST}:{port}/mcp"
+        }
+    return {
+        "transport": "stdio",
+        "command": "uv",
+        "args": [
+            "run",
+            script
+        ]
+    }
+
+def _build_mcp_client() -> MultiServerMCPClient:
+    """Crea el cliente de los servidores MCP de habitaciones y dispositivos."""
+    if MCP_SERVERS == "combined":
+        return MultiServerMCPClient(
+            {
+                "mcp_domotica": _mcp_connection(
+                    "./servers/mcp_all.py",
+                    int(os.getenv("MCP_ALL_PORT", "8000"))
+                )
+            }
+        )
+    return MultiServerMCPClient(
+        {
+            "mcp_rooms": _mcp_connection(
+                "./servers/mcp_rooms.py",
+                int(os.getenv("MCP_ROOMS_PORT", "8001"))
+            ),
+            "mcp_devices": _mcp_connection(
+                "./servers/mcp_devices.py",
+                int(os.getenv("MCP_DEVICES_PORT", "8002"))
+            )
+        }
+    )
+
+async def _warm_up_model(llm: ChatOllama, prompt: str, tools) -> None:
+    """Precalienta un modelo para que Ollama tenga en caché el prefijo del prompt.
+    
+    Se envía el mismo prefijo que usa el agente (system prompt + herramientas)
+    generando un único token, sin ejecutar ninguna herramienta.
+    """
+    try:
+        await llm.bind_tools(tools).ainvoke(
+            [SystemMessage(prompt), HumanMessage("ping")],
+            options={"num_predict": 1}
+        )
+    except Exception as e:
+        print(f"⚠️  No se pudo precalentar {llm.model}: {type(e).__name__}: {str(e)}")
+
 async def lifespan(app: FastAPI):
     """Gestiona el ciclo de vida de la aplicación."""
-    global tools, agent
+    global model, small_model, client, tools, agent, agent_small
+    # Crear los archivos de datos antes de que los usen los servidores MCP
+    get_storage().bootstrap()
+    # Hilos disponibles para los endpoints síncronos (por defecto anyio usa 40).
+    # Son lecturas cortas ligadas a I/O: más hilos solo cuestan memoria de pila.
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    model, small_model = _build_models()
+    client = _build_mcp_client()
+    # get_tools() ya inicia los servidores MCP en paralelo (asyncio.gather),
+    # por lo que el arranque tarda lo que el servidor más lento, no la suma
+    started = time.perf_counter()
     tools = await client.get_tools()
+    print(f"🔌 Servidores MCP listos en {time.perf_counter() - started:.2f}s ({len(tools)} herramientas)")
     agent = create_agent(model, tools, system_prompt=system_prompt)
+    if small_model is not None:
+        agent_small = create_agent(small_model, tools, system_prompt=small_system_prompt)
+        await _warm_up_model(small_model, small_system_prompt, tools)
+    await _warm_up_model(model, system_prompt, tools)
     yield
 
-app = FastAPI(title="Domótica MCP API", lifespan=lifespan)
+app = FastAPI(
+    title="Domótica MCP API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -81,97 +183,306 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-model = ChatOllama(
-    model="gpt-oss:120b-cloud", 
-    base_url="http://127.0.0.1:11434"
-)
-
-client = MultiServerMCPClient(
-    {
-        "mcp_rooms": {
-            "transport": "stdio",
-            "command": "uv",
-            "args": [
-                "run",
-                "./servers/mcp_rooms.py"
-            ]
-        },
-        "mcp_devices": {
-            "transport": "stdio",
-            "command": "uv",
-            "args": [
-                "run",
-                "./servers/mcp_devices.py"
-            ]
-        }
-    }
-)
-
-# Modelos de datos
-class ChatRequest(BaseModel):
+# Modelos de datos (msgspec: decodificación/codificación en C sin pasar por pydantic)
+class ChatRequest(msgspec.Struct, forbid_unknown_fields=True):
     message: str
 
-class ChatResponse(BaseModel):
-    tools_used: list[dict]
+class ToolCall(msgspec.Struct, forbid_unknown_fields=True):
+    name: str
+    args: dict[str, Any]
+
+class ChatResponse(msgspec.Struct, forbid_unknown_fields=True):
+    tools_used: list[ToolCall]
     response: str
 
+async def _decode_chat_request(http_request: Request) -> ChatRequest:
+    """Decodifica y valida el cuerpo JSON de una petición de chat."""
+    try:
+        return msgspec.json.decode(await http_request.body(), type=ChatRequest)
+    except msgspec.DecodeError as e:  # incluye msgspec.ValidationError
+        raise HTTPException(status_code=422, detail=str(e))
+
+def _chat_response(response_text: str, tools_used: list[dict]) -> Response:
+    """Codifica la respuesta de /chat/sync directamente a bytes JSON."""
+    payload = ChatResponse(
+        # Si no hay respuesta, proporcionar un mensaje por defecto
+        response=response_text or "Operación completada.",
+        tools_used=[ToolCall(name=t["name"], args=t["args"]) for t in tools_used]
+    )
+    return Response(content=msgspec.json.encode(payload), media_type="application/json")
+
 # ========== ENDPOINTS DE CHAT ==========
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    """Endpoint para enviar mensajes al agente de domótica."""
+
+def _sse(payload: dict) -> str:
+    """Formatea un evento Server-Sent Events con payload JSON."""
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+def _carry_over(trajectory: list) -> list:
+    """Filtra la trayectoria del modelo pequeño para continuarla con el grande.
+    
+    Se conservan las llamadas a herramientas y sus resultados (ya ejecutados),
+    descartando respuestas vacías o el token de derivación.
+    """
+    return [m for m in trajectory if isinstance(m, ToolMessage) or getattr(m, "tool_calls", None)]
+
+# Caché de respuestas a consultas repetidas. La clave incluye el ETag de storage,
+# así cualquier cambio en habitaciones o dispositivos invalida las entradas.
+_chat_cache: TTLCache = TTLCache(maxsize=512, ttl=30)
+READ_ONLY_TOOL_PREFIX = "consultar_"
+
+def _chat_cache_key(message: str) -> tuple[str, str]:
+    """Clave de caché: mensaje normalizado + versión actual de los datos.
+    
+    Puede recargar los archivos de datos: llamarla en el threadpool, no en el event loop.
+    """
+    storage = get_storage()
+    storage.reload()
+    return (message.strip().lower(), storage.etag)
+
+def _is_cacheable(tools_used: list[dict]) -> bool:
+    """Solo se cachean respuestas que no modificaron el estado (consultas)."""
+    return all(t["name"].startswith(READ_ONLY_TOOL_PREFIX) for t in tools_used)
+
+# Límite de inferencias simultáneas contra Ollama. Su OLLAMA_NUM_PARALLEL es el
+# total del servidor: cada worker (proceso) tiene su propio semáforo, así que se
+# reparte entre WORKERS (que __main__ exporta a los workers; 1 con `uvicorn main:app`).
+# Cada worker admite al menos una, por lo que con más workers que OLLAMA_NUM_PARALLEL
+# el total pasa a ser WORKERS y el exceso espera en la cola del propio Ollama.
+# Más peticiones esperan en cola; si la cola está llena se responde 429.
+WORKERS = int(os.getenv("WORKERS", "1"))
+CHAT_CONCURRENCY = max(1, int(os.getenv("OLLAMA_NUM_PARALLEL", "4")) // WORKERS)
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "16"))
+CHAT_RETRY_AFTER = os.getenv("CHAT_RETRY_AFTER", "5")  # segundos
+_chat_semaphore = asyncio.Semaphore(CHAT_CONCURRENCY)
+_chat_waiting = 0
+
+def _check_chat_capacity() -> None:
+    """Rechaza la petición (429) si la cola de espera hacia Ollama está llena."""
+    if _chat_semaphore.locked() and _chat_waiting >= CHAT_MAX_QUEUE:
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas peticiones de chat en curso, reintentar más tarde",
+            headers={"Retry-After": CHAT_RETRY_AFTER}
+        )
+
+async def _acquire_chat_slot() -> None:
+    """Espera un turno de inferencia; liberar con `_chat_semaphore.release()`."""
+    global _chat_waiting
+    _chat_waiting += 1
+    try:
+        await _chat_semaphore.acquire()
+    finally:
+        _chat_waiting -= 1
+
+def _chat_agents() -> tuple:
+    """Agentes a probar en orden: el pequeño (si está configurado) y el grande."""
+    return (agent,) if agent_small is None else (agent_small, agent)
+
+@app.post("/chat")
+async def chat(http_request: Request):
+    """Endpoint para enviar mensajes al agente de domótica (streaming SSE).
+    
+    Emite un evento `{"delta": ...}` por cada fragmento de texto generado por el
+    modelo y un evento final `{"tools_used": [...], "response": ...}` con las
+    herramientas usadas y el texto completo emitido.
+    La petición la atiende primero el modelo pequeño; si no produce nada o pide
+    derivar, se continúa la conversación con el modelo grande.
+    """
+    request = await _decode_chat_request(http_request)
+    
+    # Verificar que el sistema esté inicializado
+    if agent is None or tools is None:
+        raise HTTPException(status_code=503, detail="Sistema no inicializado")
+    
+    cache_key = await to_thread.run_sync(_chat_cache_key, request.message)
+    if cache_key not in _chat_cache:
+        _check_chat_capacity()
+    
+    async def gen():
+        cached = _chat_cache.get(cache_key)
+        if cached is not None:
+            response_text, tools_used = cached
+            if response_text:
+                yield _sse({"delta": response_text})
+            yield _sse({"tools_used": tools_used, "response": response_text})
+            return
+        
+        tools_used = []
+        # Fragmentos emitidos; se unen una sola vez al final
+        parts: list[str] = []
+        messages = [("user", request.message)]
+        await _acquire_chat_slot()
+        try:
+            for current_agent in _chat_agents():
+                trajectory = []
+                # Texto retenido mientras pueda ser el token de derivación
+                pending = ""
+                try:
+                    # "messages" entrega los fragmentos de texto a medida que se generan,
+                    # "updates" entrega los mensajes completos (con tool_calls) de cada nodo
+                    async for mode, data in current_agent.astream(
+                        {"messages": messages},
+                        stream_mode=["messages", "updates"]
+                    ):
+                        if mode == "messages":
+                            message, _metadata = data
+                            if not isinstance(message, AIMessageChunk) or not message.content:
+                                continue
+                            delta = message.content
+                            if pending is not None:
+                                pending += delta
+                                if ESCALATION_TOKEN.startswith(pending.strip()):
+                                    continue
+                                delta, pending = pending, None
+                            parts.append(delta)
+                            yield _sse({"delta": delta})
+                        else:
+                            for node_update in data.values():
+                                for msg in (node_update or {}).get("messages", []):
+                                    trajectory.append(msg)
+                                    for tool_call in getattr(msg, "tool_calls", None) or []:
+                                        tools_used.append({
+                                            "name": tool_call["name"],
+                                            "args": tool_call["args"]
+                                        })
+                except Exception as e:
+                    # Solo se recupera si el pequeño falló antes de emitir texto
+                    if current_agent is agent or pending is None:
+                        raise
+                    # Fallo del modelo pequeño (p. ej. no descargado): seguir con el grande
+                    print(f"⚠️  Modelo pequeño no disponible, se usa el grande: {type(e).__name__}: {str(e)}")
+                    messages = messages + _carry_over(trajectory)
+                    continue
+                
+                # Se emitió texto real o se usaron herramientas sin pedir derivación
+                if pending is None:
+                    break
+                used_tools = any(getattr(m, "tool_calls", None) for m in trajectory)
+                if pending.strip() != ESCALATION_TOKEN and (pending or used_tools):
+                    if pending:
+                        parts.append(pending)
+                        yield _sse({"delta": pending})
+                    break
+                # Derivar al modelo grande conservando lo ya ejecutado
+                messages = messages + _carry_over(trajectory)
+        except Exception as e:
+            print(f"Error en /chat: {type(e).__name__}: {str(e)}")
+            yield _sse({"error": str(e)})
+            yield _sse({"tools_used": tools_used, "response": "".join(parts)})
+            return
+        finally:
+            _chat_semaphore.release()
+        
+        response_text = "".join(parts)
+        if _is_cacheable(tools_used):
+            _chat_cache[cache_key] = (response_text, tools_used)
+        yield _sse({"tools_used": tools_used, "response": response_text})
+    
+    return StreamingResponse(gen(), media_type="text/event-stream")
+
+async def _run_agent(current_agent, messages: list) -> tuple[str, list[dict], list]:
+    """Ejecuta el agente y devuelve (respuesta, herramientas usadas, trayectoria)."""
+    state = await current_agent.ainvoke({"messages": messages})
+    # Solo interesan los mensajes generados en esta ejecución
+    trajectory = state["messages"][len(messages):]
+    
+    response_text = ""
+    tools_used = []
+    for msg in trajectory:
+        # Capturar herramientas usadas y la última respuesta del modelo
+        tool_calls = getattr(msg, "tool_calls", None)
+        if tool_calls:
+            tools_used.extend(
+                {"name": tool_call["name"], "args": tool_call["args"]}
+                for tool_call in tool_calls
+            )
+        elif isinstance(msg, AIMessage) and msg.content:
+            response_text = msg.content
+    
+    return response_text, tools_used, trajectory
+
+@app.post("/chat/sync")
+async def chat_sync(http_request: Request):
+    """Endpoint para enviar mensajes al agente de domótica (respuesta completa en JSON)."""
+    request = await _decode_chat_request(http_request)
+    
     try:
         # Verificar que el sistema esté inicializado
         if agent is None or tools is None:
             raise HTTPException(status_code=503, detail="Sistema no inicializado")
         
-        response_text = ""
-        tools_used = []
+        cache_key = await to_thread.run_sync(_chat_cache_key, request.message)
+        cached = _chat_cache.get(cache_key)
+        if cached is not None:
+            return _chat_response(*cached)
         
-        async for chunk in agent.astream({"messages": [("user", request.message)]}):
-            # Capturar herramientas usadas
-            if "model" in chunk:
-                model_chunk = chunk["model"]
-                if "messages" in model_chunk:
-                    for msg in model_chunk["messages"]:
-                        if hasattr(msg, "tool_calls") and msg.tool_calls:
-                            for tool_call in msg.tool_calls:
-                                tools_used.append({
-                                    "name": tool_call["name"],
-                                    "args": tool_call["args"]
-                                })
-                        elif hasattr(msg, "content") and msg.content:
-                            if msg.__class__.__name__ == "AIMessage":
-                                response_text = msg.content
+        messages = [("user", request.message)]
         
-        # Si no hay respuesta, proporcionar un mensaje por defecto
-        if not response_text:
-            response_text = "Operación completada."
+        _check_chat_capacity()
+        await _acquire_chat_slot()
+        try:
+            # Primero el modelo pequeño (si hay); derivar al grande si no resolvió
+            # la petición o si falló
+            response_text, tools_used, trajectory = "", [], []
+            escalate = True
+            if agent_small is not None:
+                try:
+                    response_text, tools_used, trajectory = await _run_agent(agent_small, messages)
+                    escalate = response_text.strip() == ESCALATION_TOKEN or (not response_text and not tools_used)
+                except Exception as e:
+                    print(f"⚠️  Modelo pequeño no disponible, se usa el grande: {type(e).__name__}: {str(e)}")
+            if escalate:
+                messages = messages + _carry_over(trajectory)
+                response_text, large_tools_used, _ = await _run_agent(agent, messages)
+                tools_used += large_tools_used
+        finally:
+            _chat_semaphore.release()
         
-        return ChatResponse(response=response_text, tools_used=tools_used)
+        if _is_cacheable(tools_used):
+            _chat_cache[cache_key] = (response_text, tools_used)
+        
+        return _chat_response(response_text, tools_used)
     
+    except HTTPException:
+        raise
     except ValueError as e:
         # Errores de validación del sistema domótico
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         # Log del error para debugging
-        print(f"Error en /chat: {type(e).__name__}: {str(e)}")
+        print(f"Error en /chat/sync: {type(e).__name__}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ========== CACHÉ HTTP ==========
+
+def _not_modified(request: Request, response: Response, etag: str) -> bool:
+    """Añade el ETag a la respuesta e indica si el cliente ya tiene esa versión."""
+    response.headers["ETag"] = etag
+    return request.headers.get("if-none-match") == etag
+
 # ========== ENDPOINTS DE HABITACIONES ==========
 
+# Los endpoints de lectura son síncronos (def): FastAPI los ejecuta en su
+# threadpool, así el acceso a disco de storage no bloquea el event loop
+# (y con ello el streaming de /chat).
+
 @app.get("/rooms")
-async def get_rooms():
+def get_rooms(request: Request, response: Response):
     """Obtiene la lista de todas las habitaciones."""
     try:
-        return {"rooms": storage.list_rooms()}
+        storage = get_storage()
+        with storage.snapshot() as etag:
+            if _not_modified(request, response, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+            return {"rooms": storage.list_rooms()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/rooms/{room_name}")
-async def get_room(room_name: str):
+def get_room(room_name: str):
     """Obtiene información detallada de una habitación."""
     try:
-        return storage.get_room_info(room_name)
+        return get_storage().get_room_info(room_name)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -180,49 +491,64 @@ async def get_room(room_name: str):
 # ========== ENDPOINTS DE DISPOSITIVOS ==========
 
 @app.get("/devices")
-async def get_devices(room: Optional[str] = None):
+def get_devices(request: Request, response: Response, room: Optional[str] = None):
     """Obtiene la lista de todos los dispositivos, opcionalmente filtrados por habitación."""
     try:
-        return {"devices": storage.list_devices(room_filter=room)}
+        storage = get_storage()
+        with storage.snapshot() as etag:
+            if _not_modified(request, response, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+            return {"devices": storage.list_devices(room_filter=room)}
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/devices/{device_id}")
-async def get_device(device_id: str):
+def get_device(device_id: str):
     """Obtiene información detallada de un dispositivo."""
     try:
-        storage.reload()
-        if device_id not in storage.devices:
-            raise HTTPException(status_code=404, detail=f"Dispositivo '{device_id}' no encontrado")
-        return storage.devices[device_id].to_dict()
+        return get_storage().get_device_info(device_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # ========== ENDPOINT DE ESTADO GENERAL ==========
 
 @app.get("/status")
-async def get_status():
+def get_status(request: Request, response: Response):
     """Obtiene el estado general del sistema domótico."""
     try:
-        storage.reload()
-        return {
-            "rooms": storage.list_rooms(),
-            "devices": storage.list_devices(),
-            "total_rooms": len(storage.rooms),
-            "total_devices": len(storage.devices)
-        }
+        storage = get_storage()
+        with storage.snapshot() as etag:
+            if _not_modified(request, response, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+            return storage.get_status()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # ========== ENDPOINT DE SALUD ==========
 
 @app.get("/health")
-async def health():
+def health():
     """Verifica que el servidor esté funcionando."""
     return {"status": "ok"}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=3000)
+    # Cada worker ejecuta su propio lifespan, por lo que inicia su propio agente
+    # y, con MCP_TRANSPORT=stdio, sus propios subprocesos MCP. Con
+    # MCP_TRANSPORT=http todos los workers comparten los mismos servidores.
+    # El estado compartido vive en el archivo JSON de storage.
+    workers = int(os.getenv("WORKERS", 2 * (os.cpu_count() or 1) + 1))
+    # Los workers importan este módulo de nuevo: así reparten CHAT_CONCURRENCY
+    os.environ["WORKERS"] = str(workers)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=3000,
+        workers=workers,
+        loop="auto",  # uvloop si está disponible (uvicorn[standard], no Windows)
+        http="auto"   # httptools si está disponible
+    )
@@ -1,35 +1,53 @@
 from dataclasses import dataclass, field
-from typing import Literal, Any
+from typing import Literal, Any, Optional
 
-@dataclass
+@dataclass(slots=True)
 class Device:
     """Dispositivo en el sistema."""
     id: str
     type: Literal["light", "thermostat", "fan", "oven"]
     room: str
     state: bool | int | dict[str, Any]  # bool para luces, int para termostato/ventilador, dict para horno
+    _dict: Optional[dict] = field(default=None, init=False, repr=False, compare=False)
+    
+    def __setattr__(self, name: str, value: Any) -> None:
+        """Invalida la serialización cacheada al modificar cualquier campo."""
+        object.__setattr__(self, name, value)
+        if name != "_dict":
+            object.__setattr__(self, "_dict", None)
     
     def to_dict(self) -> dict:
-        """Convierte a diccionario para serialización."""
-        return {
-            "id": self.id,
-            "type": self.type,
-            "room": self.room,
-            "state": self.state
-        }
+        """Convierte a diccionario para serialización (cacheado hasta el próximo cambio)."""
+        if self._dict is None:
+            self._dict = {
+                "id": self.id,
+                "type": self.type,
+                "room": self.room,
+                "state": self.state
+            }
+        return self._dict
 
-@dataclass
+@dataclass(slots=True)
 class Room:
     """Habitación que contiene dispositivos."""
     name: str
     type: str  # comedor, cocina, baño, living, dormitorio
-    devices: list[str] = field(default_factory=list)
+    # IDs de sus dispositivos; dict con valores None para borrar en O(1) manteniendo el orden
+    devices: dict[str, None] = field(default_factory=dict)
+    # Número de dispositivos por tipo, mantenido por storage al añadir/mover/eliminar
+    type_counts: dict[str, int] = field(
+        default_factory=lambda: {"light": 0, "thermostat": 0, "fan": 0, "oven": 0}
+    )
     
     def to_dict(self) -> dict:
         """Convierte a diccionario para serialización."""
         return {
             "name": self.name,
             "type": self.type,
-            "devices": self.devices.copy(),
+            "devices": list(self.devices),
             "device_count": len(self.devices)
         }
+    
+    def to_json_dict(self) -> dict:
+        """Forma persistida en el archivo JSON (sin campos derivados)."""
+        return {"name": self.name, "type": self.type, "devices": list(self.devices)}
@@ -0,0 +1,53 @@
+import os
+import sys
+from pathlib import Path
+
+# Añadir directorio backend al path (una sola vez, aunque se carguen ambos servidores)
+backend_dir = str(Path(__file__).parent.parent)
+if backend_dir not in sys.path:
+    sys.path.insert(0, backend_dir)
+
+from mcp.server.fastmcp import FastMCP
+
+from storage import get_storage
+
+from servers.mcp_rooms import mcp as rooms_mcp
+from servers.mcp_devices import mcp as devices_mcp
+
+# Servidor único que expone habitaciones y dispositivos: un solo proceso,
+# una sola instancia de storage y una sola lectura del archivo JSON
+mcp = FastMCP(
+    "Domótica",
+    host=os.getenv("MCP_HOST", "127.0.0.1"),
+    port=int(os.getenv("MCP_ALL_PORT", "8000"))
+)
+
+def _mount(server: FastMCP) -> None:
+    """Registra en `mcp` los prompts, recursos y herramientas de otro servidor."""
+    for prompt in server._prompt_manager.list_prompts():
+        mcp.add_prompt(prompt)
+    for resource in server._resource_manager.list_resources():
+        mcp.add_resource(resource)
+    for template in server._resource_manager.list_templates():
+        mcp.resource(
+            template.uri_template,
+            name=template.name,
+            description=template.description,
+            mime_type=template.mime_type
+        )(template.fn)
+    for tool in server._tool_manager.list_tools():
+        mcp.add_tool(
+            tool.fn,
+            name=tool.name,
+            description=tool.description,
+            annotations=tool.annotations
+        )
+
+_mount(rooms_mcp)
+_mount(devices_mcp)
+
+if __name__ == "__main__":
+    get_storage().bootstrap()
+    # stdio: un proceso por cliente; http: un único proceso compartido
+    transport = "streamable-http" if os.getenv("MCP_TRANSPORT", "stdio") == "http" else "stdio"
+    mcp.run(transport=transport)
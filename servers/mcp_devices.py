@@ -1,24 +1,111 @@
+import os
 import sys
 from pathlib import Path
 
-# Añadir directorio backend al path
-backend_dir = Path(__file__).parent.parent
-sys.path.insert(0, str(backend_dir))
+# Añadir directorio backend al path (una sola vez, aunque se carguen ambos servidores)
+backend_dir = str(Path(__file__).parent.parent)
+if backend_dir not in sys.path:
+    sys.path.insert(0, backend_dir)
 
 from mcp.server.fastmcp import FastMCP
-from typing import Optional
-from storage import storage
-
-mcp = FastMCP("Gestión de Dispositivos")
+from types import MappingProxyType
+from typing import Optional, Required, TypedDict
+from storage import DomoticaStorage, cached, get_storage
+
+mcp = FastMCP(
+    "Gestión de Dispositivos",
+    host=os.getenv("MCP_HOST", "127.0.0.1"),
+    port=int(os.getenv("MCP_DEVICES_PORT", "8002"))
+)
+
+# Límites de los termostatos (constantes de clase de storage, fijas en ejecución)
+MIN_TEMP = DomoticaStorage.MIN_TEMP
+MAX_TEMP = DomoticaStorage.MAX_TEMP
+
+# Etiquetas y orden de presentación de cada tipo de dispositivo (tablas de solo lectura)
+_TYPE_LABELS = MappingProxyType({
+    'light': '💡 Luz',
+    'thermostat': '🌡️ Termostato',
+    'fan': '🌀 Ventilador',
+    'oven': '🔥 Horno'
+})
+_TYPE_ORDER: tuple[str, ...] = ('light', 'thermostat', 'fan', 'oven')
+_VALID_TYPES = frozenset(_TYPE_ORDER)
+_TYPE_NAMES = MappingProxyType({
+    'light': 'una luz',
+    'thermostat': 'un termostato',
+    'fan': 'un ventilador',
+    'oven': 'un horno'
+})
+
+# ========== HELPERS ==========
+
+def _require(device_id: str, expected_type: Optional[str] = None):
+    """Devuelve el dispositivo con una sola búsqueda, validando su tipo si se indica."""
+    device = get_storage().devices.get(device_id)
+    if device is None:
+        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
+    if expected_type and device.type != expected_type:
+        raise ValueError(
+            f"Dispositivo '{device_id}' no es {_TYPE_NAMES[expected_type]}, es un {device.type}"
+        )
+    return device
+
+def _parse_bool(value: str | bool | int) -> bool:
+    if isinstance(value, (bool, int)):
+        return bool(value)
+    text = str(value).strip().lower()
+    if text not in ("true", "false"):
+        raise ValueError(f"Estado de luz no válido: {value!r} (se espera true/false)")
+    return text == "true"
+
+# Conversión del estado recibido como string según el tipo de dispositivo.
+# El horno no admite estado textual: se configura con sus herramientas específicas
+_STATE_PARSERS = MappingProxyType({
+    'light': _parse_bool,
+    'thermostat': int,
+    'fan': int
+})
+
+def _parse_state(device_id: str, state: Optional[str | bool | int]):
+    """Convierte el estado recibido (string o ya tipado) al tipo que usa el dispositivo."""
+    if state is None:
+        return None
+    device = get_storage().devices.get(device_id)
+    parser = _STATE_PARSERS.get(device.type) if device else None
+    return parser(state) if parser else None
+
+# ========== FORMATO DE ESTADOS ==========
+
+def _fmt_light(state) -> str:
+    return '✓ Encendida' if state else '✗ Apagada'
+
+def _fmt_thermostat(state) -> str:
+    return f"{state}°C"
+
+def _fmt_fan(state) -> str:
+    return "Apagado" if state == 0 else f"Velocidad {state}/5"
+
+def _fmt_oven(state) -> str:
+    # storage garantiza que el estado del horno es un diccionario completo
+    timer = state['timer']
+    estado = f"{'🟢 Activo' if state['active'] else '⚪ Inactivo'} - {state['temperature']}°C"
+    if timer > 0:
+        estado += f" - ⏲️ {timer} min"
+    return estado
+
+# Formateador de estado y cabecera de sección por tipo de dispositivo
+_FORMATTERS = MappingProxyType({
+    'light': (_fmt_light, "💡 LUCES:\n"),
+    'thermostat': (_fmt_thermostat, "🌡️ TERMOSTATOS:\n"),
+    'fan': (_fmt_fan, "🌀 VENTILADORES:\n"),
+    'oven': (_fmt_oven, "🔥 HORNOS:\n")
+})
 
 # ========== PROMPT ==========
 
-@mcp.prompt()
-def device_manager_role() -> str:
-    """
-    Define el rol y responsabilidades del servidor de gestión de dispositivos.
-    """
-    return """
+# Rol del servidor de dispositivos (texto constante, se devuelve tal cual)
+_DEVICE_MANAGER_ROLE = """
     Eres un asistente especializado en la GESTIÓN DE DISPOSITIVOS de un sistema domótico.
     
     TUS RESPONSABILIDADES:
@@ -59,121 +146,101 @@ def device_manager_role() -> str:
     - Confirma los cambios de estado realizados
     """
 
+@mcp.prompt()
+def device_manager_role() -> str:
+    """
+    Define el rol y responsabilidades del servidor de gestión de dispositivos.
+    """
+    return _DEVICE_MANAGER_ROLE
+
 # ========== RESOURCES ==========
 
-@mcp.resource("domotica://devices/state")
-def get_devices_state() -> str:
+@mcp.resource("domotica://devices/state", mime_type="application/json")
+def get_devices_state() -> dict:
+    """
+    Obtiene el estado actual de todos los dispositivos del sistema en formato JSON.
+    """
+    devices = get_storage().list_devices()
+    return {"devices": devices, "total": len(devices)}
+
+@mcp.resource("domotica://devices/{device_id}", mime_type="application/json")
+def get_device_detail(device_id: str) -> dict:
+    """
+    Obtiene la información de un dispositivo específico en formato JSON.
+    """
+    return get_storage().get_device_info(device_id)
+
+@mcp.resource("domotica://devices/state/pretty")
+@cached
+def get_devices_state_pretty() -> str:
     """
     Obtiene el estado actual de todos los dispositivos del sistema.
     Proporciona información detallada por tipo de dispositivo.
     """
-    output = "=== ESTADO DE DISPOSITIVOS ===\n\n"
+    parts = ["=== ESTADO DE DISPOSITIVOS ===\n\n"]
     
-    devices = storage.list_devices()
+    devices = get_storage().list_devices()
     
     if not devices:
-        output += "No hay dispositivos en el sistema.\n"
-        return output
-    
-    # Agrupar por tipo
-    by_type = {
-        'light': [],
-        'thermostat': [],
-        'fan': [],
-        'oven': []
-    }
+        parts.append("No hay dispositivos en el sistema.\n")
+        return "".join(parts)
     
+    # Agrupar por tipo en una sola pasada
+    by_type = {}
     for dev in devices:
-        dev_type = dev['type']
-        if dev_type in by_type:
-            by_type[dev_type].append(dev)
-    
-    # Luces
-    if by_type['light']:
-        output += "💡 LUCES:\n"
-        for dev in by_type['light']:
-            estado = '✓ Encendida' if dev['state'] else '✗ Apagada'
-            output += f"   {dev['id']} ({dev['room']}): {estado}\n"
-        output += "\n"
-    
-    # Termostatos
-    if by_type['thermostat']:
-        output += "🌡️ TERMOSTATOS:\n"
-        for dev in by_type['thermostat']:
-            output += f"   {dev['id']} ({dev['room']}): {dev['state']}°C\n"
-        output += "\n"
-    
-    # Ventiladores
-    if by_type['fan']:
-        output += "🌀 VENTILADORES:\n"
-        for dev in by_type['fan']:
-            estado = "Apagado" if dev['state'] == 0 else f"Velocidad {dev['state']}/5"
-            output += f"   {dev['id']} ({dev['room']}): {estado}\n"
-        output += "\n"
-    
-    # Hornos
-    if by_type['oven']:
-        output += "🔥 HORNOS:\n"
-        for dev in by_type['oven']:
-            if isinstance(dev['state'], dict):
-                temp = dev['state'].get('temperature', 0)
-                timer = dev['state'].get('timer', 0)
-                active = dev['state'].get('active', False)
-                estado = f"{'🟢 Activo' if active else '⚪ Inactivo'} - {temp}°C"
-                if timer > 0:
-                    estado += f" - ⏲️ {timer} min"
-                output += f"   {dev['id']} ({dev['room']}): {estado}\n"
-            else:
-                output += f"   {dev['id']} ({dev['room']}): {dev['state']}\n"
-        output += "\n"
+        by_type.setdefault(dev['type'], []).append(dev)
     
-    output += f"Total: {len(devices)} dispositivos en el sistema\n"
+    for dev_type in _TYPE_ORDER:
+        group = by_type.get(dev_type)
+        if not group:
+            continue
+        fmt, header = _FORMATTERS[dev_type]
+        parts.append(header)
+        parts.extend(f"   {dev['id']} ({dev['room']}): {fmt(dev['state'])}\n" for dev in group)
+        parts.append("\n")
     
-    return output
+    parts.append(f"Total: {len(devices)} dispositivos en el sistema\n")
+    
+    return "".join(parts)
 
-@mcp.resource("domotica://devices/{device_id}")
-def get_device_detail(device_id: str) -> str:
+@mcp.resource("domotica://devices/{device_id}/pretty")
+@cached
+def get_device_detail_pretty(device_id: str) -> str:
     """
     Obtiene información detallada de un dispositivo específico.
     """
     try:
-        if device_id not in storage.devices:
-            return f"Error: Dispositivo '{device_id}' no encontrado"
-        
-        device = storage.devices[device_id].to_dict()
+        device = _require(device_id).to_dict()
         
-        tipo_str = {
-            'light': '💡 Luz',
-            'thermostat': '🌡️ Termostato',
-            'fan': '🌀 Ventilador',
-            'oven': '🔥 Horno'
-        }.get(device['type'], device['type'])
+        tipo_str = _TYPE_LABELS.get(device['type'], device['type'])
         
-        output = f"=== DISPOSITIVO: {device_id} ===\n\n"
-        output += f"Tipo: {tipo_str}\n"
-        output += f"Habitación: {device['room']}\n"
+        parts = [
+            f"=== DISPOSITIVO: {device_id} ===\n\n",
+            f"Tipo: {tipo_str}\n",
+            f"Habitación: {device['room']}\n",
+        ]
         
         # Estado según tipo
         if device['type'] == 'light':
-            output += f"Estado: {'Encendida ✓' if device['state'] else 'Apagada ✗'}\n"
+            parts.append(f"Estado: {'Encendida ✓' if device['state'] else 'Apagada ✗'}\n")
         elif device['type'] == 'thermostat':
-            output += f"Temperatura: {device['state']}°C\n"
-            output += f"Rango permitido: {storage.MIN_TEMP}°C - {storage.MAX_TEMP}°C\n"
+            parts.append(f"Temperatura: {device['state']}°C\n")
+            parts.append(f"Rango permitido: {MIN_TEMP}°C - {MAX_TEMP}°C\n")
         elif device['type'] == 'fan':
             if device['state'] == 0:
-                output += f"Estado: Apagado\n"
+                parts.append("Estado: Apagado\n")
             else:
-                output += f"Velocidad: {device['state']}/5\n"
-            output += f"Velocidades disponibles: 0 (apagado) - 5 (máxima)\n"
+                parts.append(f"Velocidad: {device['state']}/5\n")
+            parts.append("Velocidades disponibles: 0 (apagado) - 5 (máxima)\n")
         elif device['type'] == 'oven':
-            if isinstance(device['state'], dict):
-                output += f"Temperatura: {device['state'].get('temperature', 0)}°C\n"
-                output += f"Temporizador: {device['state'].get('timer', 0)} minutos\n"
-                output += f"Estado: {'🟢 Activo' if device['state'].get('active', False) else '⚪ Inactivo'}\n"
-                output += f"\nRango temperatura: {storage.MIN_OVEN_TEMP}°C - {storage.MAX_OVEN_TEMP}°C\n"
-                output += f"Temporizador máximo: {storage.MAX_OVEN_TIMER} minutos\n"
+            state = device['state']
+            parts.append(f"Temperatura: {state['temperature']}°C\n")
+            parts.append(f"Temporizador: {state['timer']} minutos\n")
+            parts.append(f"Estado: {'🟢 Activo' if state['active'] else '⚪ Inactivo'}\n")
+            parts.append(f"\nRango temperatura: {DomoticaStorage.MIN_OVEN_TEMP}°C - {DomoticaStorage.MAX_OVEN_TEMP}°C\n")
+            parts.append(f"Temporizador máximo: {DomoticaStorage.MAX_OVEN_TIMER} minutos\n")
         
-        return output
+        return "".join(parts)
         
     except Exception as e:
         return f"Error: {str(e)}"
@@ -181,17 +248,21 @@ def get_device_detail(device_id: str) -> str:
 # ========== TOOLS - CONSULTAS ==========
 
 @mcp.tool()
-def consultar_dispositivos(room_name: Optional[str] = None) -> list[dict]:
+def consultar_dispositivos(
+    room_name: Optional[str] = None,
+    device_type: Optional[str] = None
+) -> list[dict]:
     """
-    Obtiene la lista de dispositivos. Puede filtrar por habitación.
+    Obtiene la lista de dispositivos. Puede filtrar por habitación y por tipo.
     
     Args:
         room_name: nombre de la habitación para filtrar (opcional)
+        device_type: tipo para filtrar: 'light', 'thermostat', 'fan', 'oven' (opcional)
     
     Returns:
         Lista de dispositivos con toda su información.
     """
-    return storage.list_devices(room_name)
+    return get_storage().list_devices(room_name, device_type)
 
 @mcp.tool()
 def consultar_dispositivo(device_id: str) -> dict:
@@ -204,10 +275,8 @@ def consultar_dispositivo(device_id: str) -> dict:
     Returns:
         Información completa del dispositivo.
     """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
-    
-    return storage.devices[device_id].to_dict()
+    # Devuelve el diccionario ya construido por Device.to_dict (cacheado hasta el próximo cambio)
+    return get_storage().get_device_info(device_id)
 
 # ========== TOOLS - GESTIÓN ==========
 
@@ -239,21 +308,24 @@ def agregar_dispositivo(
         - En el baño únicamente pueden añadirse luces
     
     Nota: Para configurar un horno después de crearlo, usar la herramienta 'ajustar_horno'
+    
+    Ejemplo:
+        agregar_dispositivo(room_name="cocina", device_type="light", initial_state="false")
     """
-    # Procesar initial_state según tipo
+    if device_type not in _VALID_TYPES:
+        raise ValueError(f"Tipo '{device_type}' inválido. Usar 'light', 'thermostat', 'fan' u 'oven'")
+    
+    # Procesar initial_state según tipo (oven lo ignora: configuración por defecto)
     state = None
-    if initial_state is not None and initial_state != "":
-        if device_type == "light":
-            state = initial_state.lower() == "true"
-        elif device_type in ["thermostat", "fan"]:
-            try:
-                state = int(initial_state)
-            except (ValueError, TypeError):
-                # Si no se puede convertir, usar None para valor por defecto
-                state = None
-        # Para oven, ignorar initial_state y usar None (configuración por defecto)
-    
-    return storage.add_device(room_name, device_type, state)
+    parser = _STATE_PARSERS.get(device_type)
+    if parser and initial_state:
+        try:
+            state = parser(initial_state)
+        except (ValueError, TypeError):
+            # Si no se puede convertir, usar None para valor por defecto
+            state = None
+    
+    return get_storage().add_device(room_name, device_type, state)
 
 @mcp.tool()
 def modificar_dispositivo(
@@ -276,17 +348,41 @@ def modificar_dispositivo(
     Returns:
         Estado actualizado del dispositivo.
     """
-    # Procesar state según el tipo de dispositivo
-    processed_state = None
-    if state is not None:
-        device = storage.devices.get(device_id)
-        if device:
-            if device.type == "light":
-                processed_state = state.lower() == "true"
-            elif device.type in ["thermostat", "fan"]:
-                processed_state = int(state)
+    return get_storage().update_device(device_id, room, _parse_state(device_id, state))
+
+class DeviceUpdate(TypedDict, total=False):
+    """Cambio de un dispositivo dentro de 'modificar_dispositivos'."""
+    device_id: Required[str]
+    room: Optional[str]
+    state: Optional[str | bool | int]
+
+@mcp.tool()
+def modificar_dispositivos(updates: list[DeviceUpdate]) -> list[dict]:
+    """
+    Modifica varios dispositivos a la vez y guarda los cambios una sola vez.
+    Usar para escenas que afectan a muchos dispositivos (ej: apagar todas las luces).
+    
+    Args:
+        updates: lista de cambios, cada uno con:
+            - device_id: ID del dispositivo
+            - room: nueva habitación (opcional)
+            - state: nuevo estado (opcional), igual que en 'modificar_dispositivo';
+              también se aceptan true/false y números sin comillas
     
-    return storage.update_device(device_id, room, processed_state)
+    Returns:
+        Estado actualizado de cada dispositivo, en el mismo orden.
+    
+    Ejemplo:
+        modificar_dispositivos(updates=[{"device_id": "light-01", "state": "false"}, {"device_id": "light-02", "state": "false"}])
+    """
+    storage = get_storage()
+    results = []
+    with storage.batch():
+        for update in updates:
+            device_id = update["device_id"]
+            state = _parse_state(device_id, update.get("state"))
+            results.append(storage.update_device(device_id, update.get("room"), state))
+    return results
 
 @mcp.tool()
 def eliminar_dispositivo(device_id: str) -> dict:
@@ -299,7 +395,7 @@ def eliminar_dispositivo(device_id: str) -> dict:
     Returns:
         Confirmación de eliminación.
     """
-    return storage.delete_device(device_id)
+    return get_storage().delete_device(device_id)
 
 # ========== TOOLS - CONTROL ESPECÍFICO DE LUCES ==========
 
@@ -314,15 +410,9 @@ def alternar_luz(device_id: str) -> dict:
     Returns:
         Estado actualizado de la luz.
     """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
-    
-    device = storage.devices[device_id]
-    if device.type != "light":
-        raise ValueError(f"Dispositivo '{device_id}' no es una luz, es un {device.type}")
-    
+    device = _require(device_id, "light")
     new_state = not device.state
-    return storage.update_device(device_id, state=new_state)
+    return get_storage().update_device(device_id, state=new_state)
 
 @mcp.tool()
 def encender_luz(device_id: str) -> dict:
@@ -335,14 +425,8 @@ def encender_luz(device_id: str) -> dict:
     Returns:
         Estado actualizado.
     """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
-    
-    device = storage.devices[device_id]
-    if device.type != "light":
-        raise ValueError(f"Dispositivo '{device_id}' no es una luz")
-    
-    return storage.update_device(device_id, state=True)
+    _require(device_id, "light")
+    return get_storage().update_device(device_id, state=True)
 
 @mcp.tool()
 def apagar_luz(device_id: str) -> dict:
@@ -355,14 +439,8 @@ def apagar_luz(device_id: str) -> dict:
     Returns:
         Estado actualizado.
     """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
-    
-    device = storage.devices[device_id]
-    if device.type != "light":
-        raise ValueError(f"Dispositivo '{device_id}' no es una luz")
-    
-    return storage.update_device(device_id, state=False)
+    _require(device_id, "light")
+    return get_storage().update_device(device_id, state=False)
 
 # ========== TOOLS - CONTROL ESPECÍFICO DE TERMOSTATOS ==========
 
@@ -377,15 +455,12 @@ def ajustar_termostato(device_id: str, temperature: int) -> dict:
     
     Returns:
         Estado actualizado con la nueva temperatura.
-    """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
-    
-    device = storage.devices[device_id]
-    if device.type != "thermostat":
-        raise ValueError(f"Dispositivo '{device_id}' no es un termostato")
     
-    return storage.update_device(device_id, state=temperature)
+    Ejemplo:
+        ajustar_termostato(device_id="thermo-01", temperature=22)
+    """
+    _require(device_id, "thermostat")
+    return get_storage().update_device(device_id, state=temperature)
 
 @mcp.tool()
 def subir_temperatura(device_id: str, grados: int = 1) -> dict:
@@ -399,15 +474,10 @@ def subir_temperatura(device_id: str, grados: int = 1) -> dict:
     Returns:
         Estado actualizado.
     """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
+    device = _require(device_id, "thermostat")
     
-    device = storage.devices[device_id]
-    if device.type != "thermostat":
-        raise ValueError(f"Dispositivo '{device_id}' no es un termostato")
-    
-    nueva_temp = min(device.state + grados, storage.MAX_TEMP)
-    return storage.update_device(device_id, state=nueva_temp)
+    nueva_temp = min(device.state + grados, MAX_TEMP)
+    return get_storage().update_device(device_id, state=nueva_temp)
 
 @mcp.tool()
 def bajar_temperatura(device_id: str, grados: int = 1) -> dict:
@@ -421,15 +491,10 @@ def bajar_temperatura(device_id: str, grados: int = 1) -> dict:
     Returns:
         Estado actualizado.
     """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
+    device = _require(device_id, "thermostat")
     
-    device = storage.devices[device_id]
-    if device.type != "thermostat":
-        raise ValueError(f"Dispositivo '{device_id}' no es un termostato")
-    
-    nueva_temp = max(device.state - grados, storage.MIN_TEMP)
-    return storage.update_device(device_id, state=nueva_temp)
+    nueva_temp = max(device.state - grados, MIN_TEMP)
+    return get_storage().update_device(device_id, state=nueva_temp)
 
 # ========== TOOLS - CONTROL ESPECÍFICO DE VENTILADORES ==========
 
@@ -444,21 +509,19 @@ def ajustar_ventilador(device_id: str, speed: int) -> dict:
     
     Returns:
         Estado actualizado con la nueva velocidad.
-    """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
     
-    device = storage.devices[device_id]
-    if device.type != "fan":
-        raise ValueError(f"Dispositivo '{device_id}' no es un ventilador")
+    Ejemplo:
+        ajustar_ventilador(device_id="fan-01", speed=3)
+    """
+    device = _require(device_id, "fan")
     
     # Manejar caso donde el estado no es un entero válido
     # (por ejemplo, si llega un diccionario vacío por error)
     if not isinstance(device.state, int):
         # Establecer estado por defecto antes de actualizar
-        storage.update_device(device_id, state=storage.DEFAULT_FAN_SPEED)
+        get_storage().update_device(device_id, state=DomoticaStorage.DEFAULT_FAN_SPEED)
     
-    return storage.update_device(device_id, state=speed)
+    return get_storage().update_device(device_id, state=speed)
 
 @mcp.tool()
 def apagar_ventilador(device_id: str) -> dict:
@@ -471,7 +534,8 @@ def apagar_ventilador(device_id: str) -> dict:
     Returns:
         Estado actualizado.
     """
-    return ajustar_ventilador(device_id, 0)
+    _require(device_id, "fan")
+    return get_storage().update_device(device_id, state=0)
 
 # ========== TOOLS - CONTROL ESPECÍFICO DE HORNOS ==========
 
@@ -494,22 +558,10 @@ def ajustar_horno(
     Returns:
         Estado actualizado del horno.
     """
-    if device_id not in storage.devices:
-        raise ValueError(f"Dispositivo '{device_id}' no encontrado")
-    
-    device = storage.devices[device_id]
-    if device.type != "oven":
-        raise ValueError(f"Dispositivo '{device_id}' no es un horno")
-    
-    # Obtener estado actual
-    current_state = device.state if isinstance(device.state, dict) else {
-        "temperature": storage.DEFAULT_OVEN_TEMP,
-        "timer": 0,
-        "active": False
-    }
+    device = _require(device_id, "oven")
     
-    # Preparar nuevo estado
-    new_state = current_state.copy()
+    # Preparar nuevo estado a partir del actual
+    new_state = device.state.copy()
     
     if temperature is not None:
         new_state["temperature"] = temperature
@@ -520,7 +572,7 @@ def ajustar_horno(
     if active is not None:
         new_state["active"] = active
     
-    return storage.update_device(device_id, state=new_state)
+    return get_storage().update_device(device_id, state=new_state)
 
 @mcp.tool()
 def encender_horno(device_id: str) -> dict:
@@ -533,7 +585,8 @@ def encender_horno(device_id: str) -> dict:
     Returns:
         Estado actualizado.
     """
-    return ajustar_horno(device_id, active=True)
+    device = _require(device_id, "oven")
+    return get_storage().update_device(device_id, state={**device.state, "active": True})
 
 @mcp.tool()
 def apagar_horno(device_id: str) -> dict:
@@ -546,7 +599,8 @@ def apagar_horno(device_id: str) -> dict:
     Returns:
         Estado actualizado.
     """
-    return ajustar_horno(device_id, active=False)
+    device = _require(device_id, "oven")
+    return get_storage().update_device(device_id, state={**device.state, "active": False})
 
 @mcp.tool()
 def configurar_temporizador_horno(device_id: str, minutos: int) -> dict:
@@ -560,7 +614,11 @@ def configurar_temporizador_horno(device_id: str, minutos: int) -> dict:
     Returns:
         Estado actualizado.
     """
-    return ajustar_horno(device_id, timer=minutos)
+    device = _require(device_id, "oven")
+    return get_storage().update_device(device_id, state={**device.state, "timer": minutos})
 
 if __name__ == "__main__":
-    mcp.run(transport="stdio")
+    get_storage().bootstrap()
+    # stdio: un proceso por cliente; http: un único proceso compartido
+    transport = "streamable-http" if os.getenv("MCP_TRANSPORT", "stdio") == "http" else "stdio"
+    mcp.run(transport=transport)
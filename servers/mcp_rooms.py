@@ -1,23 +1,37 @@
+import os
 import sys
 from pathlib import Path
 
-# Añadir directorio backend al path
-backend_dir = Path(__file__).parent.parent
-sys.path.insert(0, str(backend_dir))
+# Añadir directorio backend al path (una sola vez, aunque se carguen ambos servidores)
+backend_dir = str(Path(__file__).parent.parent)
+if backend_dir not in sys.path:
+    sys.path.insert(0, backend_dir)
 
 from mcp.server.fastmcp import FastMCP
-from storage import storage
+from types import MappingProxyType
+from storage import DomoticaStorage, cached, get_storage
 
-mcp = FastMCP("Gestión de Habitaciones")
+mcp = FastMCP(
+    "Gestión de Habitaciones",
+    host=os.getenv("MCP_HOST", "127.0.0.1"),
+    port=int(os.getenv("MCP_ROOMS_PORT", "8001"))
+)
+
+# Etiquetas de presentación de cada tipo de dispositivo
+_TYPE_LABELS = MappingProxyType({
+    'light': '💡 Luz',
+    'thermostat': '🌡️ Termostato',
+    'fan': '🌀 Ventilador',
+    'oven': '🔥 Horno'
+})
+
+# Tipos de habitación admitidos, para rechazar tipos inválidos sin llegar a storage
+_VALID_ROOM_TYPES = DomoticaStorage.ALLOWED_ROOM_TYPES
 
 # ========== PROMPT ==========
 
-@mcp.prompt()
-def room_manager_role() -> str:
-    """
-    Define el rol y responsabilidades del servidor de gestión de habitaciones.
-    """
-    return """
+# Rol del servidor de habitaciones
+_ROOM_MANAGER_ROLE = """
     Eres un asistente especializado en la GESTIÓN DE HABITACIONES de un sistema domótico.
     
     TUS RESPONSABILIDADES:
@@ -51,66 +65,83 @@ def room_manager_role() -> str:
     - Si hay errores, explica claramente qué salió mal y qué se necesita hacer
     """
 
+@mcp.prompt()
+def room_manager_role() -> str:
+    """
+    Define el rol y responsabilidades del servidor de gestión de habitaciones.
+    """
+    return _ROOM_MANAGER_ROLE
+
 # ========== RESOURCES ==========
 
-@mcp.resource("domotica://rooms/state")
-def get_rooms_state() -> str:
+@mcp.resource("domotica://rooms/state", mime_type="application/json")
+def get_rooms_state() -> dict:
+    """
+    Obtiene el estado actual de todas las habitaciones del sistema en formato JSON.
+    """
+    rooms = get_storage().list_rooms()
+    return {"rooms": rooms, "total_rooms": len(rooms), "max_rooms": DomoticaStorage.MAX_ROOMS}
+
+@mcp.resource("domotica://rooms/{room_name}", mime_type="application/json")
+def get_room_detail(room_name: str) -> dict:
+    """
+    Obtiene la información de una habitación específica y sus dispositivos en formato JSON.
+    """
+    return get_storage().get_room_info(room_name)
+
+@mcp.resource("domotica://rooms/state/pretty")
+@cached
+def get_rooms_state_pretty() -> str:
     """
     Obtiene el estado actual de todas las habitaciones del sistema.
     Proporciona información detallada para que el agente conozca el contexto.
     """
-    output = "=== ESTADO DE HABITACIONES ===\n\n"
+    parts = ["=== ESTADO DE HABITACIONES ===\n\n"]
     
-    rooms = storage.list_rooms()
+    rooms = get_storage().list_rooms()
     
     if not rooms:
-        output += "No hay habitaciones en el sistema.\n"
+        parts.append("No hay habitaciones en el sistema.\n")
     else:
         for room_data in rooms:
-            output += f"📍 {room_data['name']}\n"
-            output += f"   - Luces: {room_data.get('light_count', 0)}\n"
-            output += f"   - Termostatos: {room_data.get('thermostat_count', 0)}\n"
+            parts.append(f"📍 {room_data['name']}\n")
+            parts.append(f"   - Luces: {room_data.get('light_count', 0)}\n")
+            parts.append(f"   - Termostatos: {room_data.get('thermostat_count', 0)}\n")
             
-            # Contar otros dispositivos
-            room_info = storage.get_room_info(room_data['name'])
-            devices = room_info['devices']
-            fans = sum(1 for d in devices if d['type'] == 'fan')
-            ovens = sum(1 for d in devices if d['type'] == 'oven')
+            # list_rooms ya incluye el desglose por tipo
+            fans = room_data.get('fan_count', 0)
+            ovens = room_data.get('oven_count', 0)
             
             if fans > 0:
-                output += f"   - Ventiladores: {fans}\n"
+                parts.append(f"   - Ventiladores: {fans}\n")
             if ovens > 0:
-                output += f"   - Hornos: {ovens}\n"
+                parts.append(f"   - Hornos: {ovens}\n")
             
-            output += f"   - Total dispositivos: {room_data['total_devices']}\n\n"
+            parts.append(f"   - Total dispositivos: {room_data['total_devices']}\n\n")
     
-    output += f"\nOcupación: {len(rooms)}/{storage.MAX_ROOMS} habitaciones\n"
+    parts.append(f"\nOcupación: {len(rooms)}/{DomoticaStorage.MAX_ROOMS} habitaciones\n")
     
-    return output
+    return "".join(parts)
 
-@mcp.resource("domotica://rooms/{room_name}")
-def get_room_detail(room_name: str) -> str:
+@mcp.resource("domotica://rooms/{room_name}/pretty")
+@cached
+def get_room_detail_pretty(room_name: str) -> str:
     """
     Obtiene información detallada de una habitación específica.
     Incluye todos los dispositivos y su estado actual.
     """
     try:
-        room_info = storage.get_room_info(room_name)
+        room_info = get_storage().get_room_info(room_name)
         
-        output = f"=== HABITACIÓN: {room_name.upper()} ===\n\n"
+        parts = [f"=== HABITACIÓN: {room_name.upper()} ===\n\n"]
         
         devices = room_info['devices']
         if not devices:
-            output += "Esta habitación no tiene dispositivos.\n"
+            parts.append("Esta habitación no tiene dispositivos.\n")
         else:
-            output += "DISPOSITIVOS:\n"
+            parts.append("DISPOSITIVOS:\n")
             for dev in devices:
-                tipo_str = {
-                    'light': '💡 Luz',
-                    'thermostat': '🌡️ Termostato',
-                    'fan': '🌀 Ventilador',
-                    'oven': '🔥 Horno'
-                }.get(dev['type'], dev['type'])
+                tipo_str = _TYPE_LABELS.get(dev['type'], dev['type'])
                 
                 # Formatear estado según tipo
                 if dev['type'] == 'light':
@@ -120,21 +151,16 @@ def get_room_detail(room_name: str) -> str:
                 elif dev['type'] == 'fan':
                     estado = f"Apagado" if dev['state'] == 0 else f"Velocidad {dev['state']}"
                 elif dev['type'] == 'oven':
-                    if isinstance(dev['state'], dict):
-                        temp = dev['state'].get('temperature', 0)
-                        timer = dev['state'].get('timer', 0)
-                        active = dev['state'].get('active', False)
-                        estado = f"{'Activo' if active else 'Inactivo'} - {temp}°C"
-                        if timer > 0:
-                            estado += f" - Timer: {timer} min"
-                    else:
-                        estado = str(dev['state'])
+                    state = dev['state']
+                    estado = f"{'Activo' if state['active'] else 'Inactivo'} - {state['temperature']}°C"
+                    if state['timer'] > 0:
+                        estado += f" - Timer: {state['timer']} min"
                 else:
                     estado = str(dev['state'])
                 
-                output += f"  • {dev['id']} ({tipo_str}): {estado}\n"
+                parts.append(f"  • {dev['id']} ({tipo_str}): {estado}\n")
         
-        return output
+        return "".join(parts)
         
     except ValueError as e:
         return f"Error: {str(e)}"
@@ -149,7 +175,7 @@ def consultar_habitaciones() -> list[dict]:
     Returns:
         Lista de habitaciones con nombre y cantidad de dispositivos por tipo.
     """
-    return storage.list_rooms()
+    return get_storage().list_rooms()
 
 @mcp.tool()
 def consultar_habitacion(room_name: str) -> dict:
@@ -162,7 +188,7 @@ def consultar_habitacion(room_name: str) -> dict:
     Returns:
         Información completa de la habitación incluyendo todos sus dispositivos.
     """
-    return storage.get_room_info(room_name)
+    return get_storage().get_room_info(room_name)
 
 # ========== TOOLS - GESTIÓN ==========
 
@@ -181,8 +207,16 @@ def agregar_habitacion(room_type: str) -> dict:
         - Máximo 6 habitaciones en el sistema
         - Solo tipos permitidos: comedor, cocina, baño, living, dormitorio
         - El sistema numera automáticamente (ej: si ya existe "dormitorio", crea "dormitorio 2")
+    
+    Ejemplo:
+        agregar_habitacion(room_type="dormitorio")
     """
-    return storage.add_room(room_type)
+    if room_type not in _VALID_ROOM_TYPES:
+        raise ValueError(
+            f"Tipo de habitación '{room_type}' no válido. "
+            f"Tipos permitidos: {', '.join(DomoticaStorage.ROOM_TYPES)}"
+        )
+    return get_storage().add_room(room_type)
 
 @mcp.tool()
 def modificar_habitacion(old_name: str, new_name: str) -> dict:
@@ -197,7 +231,7 @@ def modificar_habitacion(old_name: str, new_name: str) -> dict:
     Returns:
         Confirmación con ambos nombres (antiguo y nuevo).
     """
-    return storage.update_room(old_name, new_name)
+    return get_storage().update_room(old_name, new_name)
 
 @mcp.tool()
 def eliminar_habitacion(room_name: str) -> dict:
@@ -214,7 +248,10 @@ def eliminar_habitacion(room_name: str) -> dict:
         - La habitación debe estar vacía (sin dispositivos)
         - Primero deben eliminarse todos los dispositivos de la habitación
     """
-    return storage.delete_room(room_name)
+    return get_storage().delete_room(room_name)
 
 if __name__ == "__main__":
-    mcp.run(transport="stdio")
+    get_storage().bootstrap()
+    # stdio: un proceso por cliente; http: un único proceso compartido
+    transport = "streamable-http" if os.getenv("MCP_TRANSPORT", "stdio") == "http" else "stdio"
+    mcp.run(transport=transport)
@@ -1,17 +1,215 @@
-from typing import Optional
+from typing import Iterator, Optional
 from models import Device, Room
-import json
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import atexit
+import logging
+import mmap
+import orjson
+import os
+import threading
+import uuid
 from pathlib import Path
+from types import MappingProxyType
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+class _ReadWriteLock:
+    """Lock de lectura/escritura: varios lectores a la vez o un único escritor.
+    
+    Ambos modos son reentrantes y el escritor puede leer mientras escribe.
+    Un lector no puede pasar a escritor (se bloquearía esperándose a sí mismo).
+    Los escritores en espera tienen prioridad sobre los nuevos lectores.
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer: Optional[int] = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+    
+    def reading(self) -> bool:
+        """Indica si el hilo actual ya tiene el lock de lectura."""
+        return bool(getattr(self._local, "depth", 0))
+    
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        me = threading.get_ident()
+        depth = getattr(self._local, "depth", 0)
+        if depth or self._writer == me:
+            # Lectura anidada o dentro de una escritura propia: ya protegida
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class _FileLock:
+    """Lock entre procesos sobre un archivo auxiliar (flock en POSIX, msvcrt en Windows).
+    
+    Usarlo siempre bajo el lock exclusivo de la instancia: así un solo hilo lo
+    toma a la vez y basta un contador para anidarlo. Un modo compartido dentro
+    de uno exclusivo reutiliza el exclusivo; al revés no está permitido.
+    En Windows ambos modos son exclusivos.
+    """
+    
+    def __init__(self, path: str):
+        self._path = path
+        self._fd: Optional[int] = None
+        self._depth = 0
+    
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._hold(shared=False):
+            yield
+    
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._hold(shared=True):
+            yield
+    
+    @contextmanager
+    def _hold(self, shared: bool) -> Iterator[None]:
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK se rinde tras ~10 s: seguir esperando
+                        continue
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._depth = 1
+        try:
+            yield
+        finally:
+            self._depth = 0
+            self._fd = None
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            os.close(fd)
+
+
+def _synchronized(method):
+    """Acceso exclusivo al estado compartido (métodos que lo modifican)."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _mutation(method):
+    """Como _synchronized, y además anota la operación realizada.
+    
+    Si otro proceso escribe mientras hay cambios pendientes, flush() recarga
+    los archivos y repite sobre ellos las operaciones anotadas.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            result = method(self, *args, **kwargs)
+            if not self._replaying:
+                self._ops.append((method.__name__, args, kwargs))
+            return result
+    return wrapper
+
+
+def _shared(method):
+    """Acceso de solo lectura: varias consultas pueden ejecutarse a la vez.
+    
+    La sincronización con el archivo se hace antes de tomar el lock de lectura,
+    porque recargar requiere el lock exclusivo. Dentro de `snapshot()` ya se
+    recargó y el lock de lectura está tomado, así que no se repite.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self._lock.reading():
+            self.reload()  # Sincronizar con archivo
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class DomoticaStorage:
     """Almacenamiento centralizado de habitaciones y dispositivos."""
     
     # Límites del sistema
     MAX_ROOMS = 6
-    ALLOWED_ROOM_TYPES = ["comedor", "cocina", "baño", "living", "dormitorio"]
+    # Tupla para mostrar los tipos en orden; frozenset para validar
+    ROOM_TYPES = ("comedor", "cocina", "baño", "living", "dormitorio")
+    ALLOWED_ROOM_TYPES = frozenset(ROOM_TYPES)
     MAX_DEVICES_PER_ROOM = 10
+    _ALLOWED_DEVICE_TYPES = frozenset({"light", "thermostat", "fan", "oven"})
     
     # Configuración de dispositivos
+    # Luces
+    DEFAULT_LIGHT_STATE = False
+    
     # Termostatos
     MIN_TEMP = 16
     MAX_TEMP = 32
@@ -27,47 +225,138 @@ class DomoticaStorage:
     MAX_OVEN_TEMP = 240
     DEFAULT_OVEN_TEMP = 180
     MAX_OVEN_TIMER = 240  # minutos
+    # Plantilla de solo lectura del estado inicial del horno
+    _OVEN_DEFAULT = MappingProxyType({
+        "temperature": DEFAULT_OVEN_TEMP,
+        "timer": 0,  # minutos
+        "active": False
+    })
     
-    # Archivo de persistencia
-    STORAGE_FILE = Path(__file__).parent / "domotica_data.json"
+    # Espera tras la última modificación antes de escribir en disco (segundos)
+    SAVE_DELAY = 0.05
+    
+    # Archivos de persistencia: uno por sección, para reescribir y volver a
+    # parsear solo las que cambiaron
+    DATA_DIR = Path(__file__).parent
+    _SECTIONS = ("rooms", "devices", "counters")
+    STORAGE_FILES = MappingProxyType({
+        "rooms": DATA_DIR / "domotica_rooms.json",
+        "devices": DATA_DIR / "domotica_devices.json",
+        "counters": DATA_DIR / "domotica_counters.json"
+    })
+    # Rutas como str para os.stat: evita crear objetos Path en cada reload()
+    _STORAGE_PATHS = MappingProxyType({
+        section: os.fspath(path) for section, path in STORAGE_FILES.items()
+    })
+    # Formato anterior (un único archivo); se migra al arrancar si es lo único que hay
+    LEGACY_FILE = DATA_DIR / "domotica_data.json"
+    # Diario de cambios: una línea JSON por escritura con solo lo modificado
+    # desde la anterior. Se vuelca a los archivos de sección cada CHECKPOINT_EVERY líneas
+    JOURNAL_FILE = DATA_DIR / "domotica_data.log"
+    _JOURNAL_PATH = os.fspath(JOURNAL_FILE)
+    # Coordina a los procesos que comparten los archivos (servidores MCP, workers)
+    LOCK_FILE = DATA_DIR / "domotica_data.lock"
+    CHECKPOINT_EVERY = 100
+    # Huella de un archivo que no existe
+    _MISSING = (0, 0)
     
     def __init__(self):
-        """Inicializa con datos por defecto o carga desde archivo."""
+        """Carga los datos guardados, si los hay. No escribe en disco (ver bootstrap())."""
         self.rooms: dict[str, Room] = {}
         self.devices: dict[str, Device] = {}
-        self._counters = {
-            "light": 1, 
-            "thermo": 1, 
-            "fan": 1, 
-            "oven": 1
-        }
+        # Índice (habitación, tipo) → IDs, para filtrar por ambos ejes sin recorrer todo
+        self._room_type_index: defaultdict[tuple[str, str], set[str]] = defaultdict(set)
+        # Habitaciones existentes por tipo, para numerar las nuevas sin recorrer todas
+        self._room_type_counts: defaultdict[str, int] = defaultdict(int)
+        self._counters = dict(self._DEFAULT_COUNTERS)
+        # Protege rooms/devices: la API consulta storage desde el threadpool;
+        # las consultas comparten el lock y las modificaciones lo toman en exclusiva
+        self._lock = _ReadWriteLock()
+        self._file_lock = _FileLock(os.fspath(self.LOCK_FILE))
+        # Huella (mtime, tamaño) de cada archivo y del diario en la última carga/guardado
+        self._file_stamp: Optional[tuple[tuple[int, int], ...]] = None
+        # Entradas modificadas pendientes de escribir: ("rooms"|"devices", clave)
+        # o ("counters", None). Líneas del diario desde el último volcado completo
+        # y secciones que esas líneas modifican
+        self._changes: set[tuple[str, Optional[str]]] = set()
+        # Operaciones (método, args, kwargs) aún no escritas, para repetirlas si
+        # otro proceso escribió entretanto; _replaying evita anotarlas dos veces
+        self._ops: list[tuple[str, tuple, dict]] = []
+        self._replaying = False
+        self._journal_entries = 0
+        self._unsaved_sections: set[str] = set()
+        # Última lectura de cada archivo de sección: sección → (huella, contenido)
+        self._section_data: dict[str, tuple[tuple[int, int], dict]] = {}
+        # Lotes abiertos con batch(): mientras haya alguno no se escribe en disco
+        self._batch_depth = 0
+        # Cambios en memoria aún no escritos y temporizador que los escribirá
+        self._dirty = False
+        self._save_timer: Optional[threading.Timer] = None
+        # Se incrementa con cada modificación o recarga: invalida las cachés de cached()
+        self._version = 0
+        # Listados ya calculados: clave → (versión, resultado). Se guardan como
+        # tupla y cada llamada recibe su propia lista
+        self._agg_cache: dict[tuple, tuple[int, tuple[dict, ...]]] = {}
         
         # Intentar cargar datos existentes
-        if self.STORAGE_FILE.exists():
-            self._load_from_file()
-        else:
-            # Crear datos por defecto solo si no existe el archivo
-            self.add_room("living")
-            self.add_device("living", "light", False)
-            self.add_device("living", "thermostat", 21)
+        if self._stat_file() is not None:
+            self.reload()
+        elif self.LEGACY_FILE.exists():
+            # Formato anterior: el primer guardado lo escribe ya dividido por secciones
+            self._apply_data(self._read_json(self.LEGACY_FILE))
+        
+        # No perder cambios pendientes al terminar el proceso
+        atexit.register(self.flush)
+    
+    def bootstrap(self) -> None:
+        """Prepara los archivos de datos si aún no existen.
+        
+        Migra el archivo del formato anterior o, si no hay ninguno, crea la
+        configuración por defecto. Los puntos de entrada lo llaman al arrancar;
+        varios procesos (workers, servidores MCP) pueden hacerlo a la vez: el lock
+        de archivo garantiza que solo el primero crea los datos.
+        """
+        with self._lock.write(), self._file_lock.exclusive():
+            if self._stat_file() is not None:
+                # Otro proceso se adelantó: usar sus datos
+                self.reload()
+                return
+            if not self.LEGACY_FILE.exists():
+                self.add_room("living")
+                self.add_device("living", "light", False)
+                self.add_device("living", "thermostat", 21)
+            # Sin archivos previos, el primer guardado escribe todas las secciones
+            self._dirty = True
+            self.flush()
     
     # ========== GENERACIÓN DE IDs ==========
     
+    # Prefijo del ID (y clave de contador) de cada tipo de dispositivo
+    _COUNTER_KEY = MappingProxyType({
+        "light": "light",
+        "thermostat": "thermo",
+        "fan": "fan",
+        "oven": "oven"
+    })
+    
+    # Contadores iniciales (se copian: la instancia los incrementa)
+    _DEFAULT_COUNTERS = MappingProxyType({
+        "light": 1,
+        "thermo": 1,
+        "fan": 1,
+        "oven": 1
+    })
+    
     def _generate_device_id(self, device_type: str) -> str:
         """Genera ID auto-incremental para dispositivo."""
-        key_map = {
-            "light": "light",
-            "thermostat": "thermo",
-            "fan": "fan",
-            "oven": "oven"
-        }
-        counter_key = key_map.get(device_type, device_type)
+        counter_key = self._COUNTER_KEY.get(device_type, device_type)
         device_id = f"{counter_key}-{self._counters[counter_key]:02d}"
         self._counters[counter_key] += 1
         return device_id
     
     # ========== GESTIÓN DE HABITACIONES ==========
     
+    @_mutation
     def add_room(self, room_type: str) -> dict:
         """Crea una nueva habitación."""
         self.reload()  # Sincronizar con archivo
@@ -76,19 +365,21 @@ class DomoticaStorage:
         
         # Validar que el tipo sea permitido
         if room_type not in self.ALLOWED_ROOM_TYPES:
-            raise ValueError(f"Tipo de habitación '{room_type}' no válido. Tipos permitidos: {', '.join(self.ALLOWED_ROOM_TYPES)}")
+            raise ValueError(f"Tipo de habitación '{room_type}' no válido. Tipos permitidos: {', '.join(self.ROOM_TYPES)}")
         
         # Generar nombre único con numeración
-        count = sum(1 for room in self.rooms.values() if room.type == room_type)
+        count = self._room_type_counts[room_type]
         if count == 0:
             room_name = room_type
         else:
             room_name = f"{room_type} {count + 1}"
         
         self.rooms[room_name] = Room(name=room_name, type=room_type)
-        self._save_to_file()
+        self._room_type_counts[room_type] = count + 1
+        self._save_to_file(("rooms", room_name))
         return {"room": room_name, "type": room_type, "status": "created"}
     
+    @_mutation
     def update_room(self, old_name: str, new_name: str) -> dict:
         """Renombra una habitación y actualiza sus dispositivos."""
         self.reload()  # Sincronizar con archivo
@@ -102,12 +393,22 @@ class DomoticaStorage:
         self.rooms[new_name] = room
         
         # Actualizar room en dispositivos
+        changes = [("rooms", old_name), ("rooms", new_name)]
         for device_id in room.devices:
             self.devices[device_id].room = new_name
+            changes.append(("devices", device_id))
         
-        self._save_to_file()
+        # Reindexar las entradas de la habitación con su nuevo nombre
+        if new_name != old_name:
+            for dev_type in list(room.type_counts):
+                ids = self._room_type_index.pop((old_name, dev_type), None)
+                if ids:
+                    self._room_type_index[(new_name, dev_type)] = ids
+        
+        self._save_to_file(*changes)
         return {"old_name": old_name, "new_name": new_name, "status": "updated"}
     
+    @_mutation
     def delete_room(self, name: str) -> dict:
         """Elimina una habitación (debe estar vacía)."""
         self.reload()  # Sincronizar con archivo
@@ -118,63 +419,78 @@ class DomoticaStorage:
         if room.devices:
             raise ValueError(
                 f"No se puede eliminar habitación con dispositivos. "
-                f"Eliminar primero: {room.devices}"
+                f"Eliminar primero: {list(room.devices)}"
             )
         
         del self.rooms[name]
-        self._save_to_file()
+        self._room_type_counts[room.type] -= 1
+        self._save_to_file(("rooms", name))
         return {"room": name, "status": "deleted"}
     
+    @_shared
     def list_rooms(self) -> list[dict]:
         """Lista todas las habitaciones con estadísticas."""
-        self.reload()  # Sincronizar con archivo
+        return self._aggregate(("list_rooms",), self._room_summaries)
+    
+    def _room_summaries(self) -> list[dict]:
+        """Estadísticas por habitación sobre los datos ya cargados (sin recargar)."""
         result = []
         for room in self.rooms.values():
-            lights = sum(1 for d in room.devices if self.devices[d].type == "light")
-            thermos = sum(1 for d in room.devices if self.devices[d].type == "thermostat")
-            fans = sum(1 for d in room.devices if self.devices[d].type == "fan")
-            ovens = sum(1 for d in room.devices if self.devices[d].type == "oven")
-            
+            counts = room.type_counts
             result.append({
                 "name": room.name,
                 "type": room.type,
-                "light_count": lights,
-                "thermostat_count": thermos,
-                "fan_count": fans,
-                "oven_count": ovens,
+                "light_count": counts["light"],
+                "thermostat_count": counts["thermostat"],
+                "fan_count": counts["fan"],
+                "oven_count": counts["oven"],
                 "total_devices": len(room.devices)
             })
         return result
     
+    @_shared
     def get_room_info(self, name: str) -> dict:
         """Obtiene información detallada de una habitación."""
-        self.reload()  # Sincronizar con archivo
         if name not in self.rooms:
             raise ValueError(f"Habitación '{name}' no existe")
         
         room = self.rooms[name]
         devices = [self.devices[dev_id].to_dict() for dev_id in room.devices]
         
-        lights = sum(1 for d in devices if d["type"] == "light")
-        thermos = sum(1 for d in devices if d["type"] == "thermostat")
-        
         return {
             "room": name,
             "type": room.type,
             "devices": devices,
-            "light_count": lights,
-            "thermostat_count": thermos
+            "light_count": room.type_counts["light"],
+            "thermostat_count": room.type_counts["thermostat"]
         }
     
     # ========== GESTIÓN DE DISPOSITIVOS ==========
     
+    def _attach(self, room: Room, device: Device) -> None:
+        """Añade el dispositivo a la habitación y actualiza su recuento por tipo."""
+        room.devices[device.id] = None
+        room.type_counts[device.type] = room.type_counts.get(device.type, 0) + 1
+        self._room_type_index[(room.name, device.type)].add(device.id)
+    
+    def _detach(self, room: Room, device: Device) -> None:
+        """Quita el dispositivo de la habitación y actualiza su recuento por tipo."""
+        del room.devices[device.id]
+        room.type_counts[device.type] -= 1
+        key = (room.name, device.type)
+        ids = self._room_type_index[key]
+        ids.discard(device.id)
+        if not ids:
+            del self._room_type_index[key]
+    
+    @_mutation
     def add_device(self, room_name: str, device_type: str, initial_state=None) -> dict:
         """Añade un dispositivo a una habitación."""
         self.reload()  # Sincronizar con archivo
         if room_name not in self.rooms:
             raise ValueError(f"Habitación '{room_name}' no existe")
         
-        if device_type not in ["light", "thermostat", "fan", "oven"]:
+        if device_type not in self._ALLOWED_DEVICE_TYPES:
             raise ValueError(f"Tipo '{device_type}' inválido. Usar 'light', 'thermostat', 'fan' u 'oven'")
         
         room = self.rooms[room_name]
@@ -191,29 +507,14 @@ class DomoticaStorage:
             raise ValueError(f"Máximo {self.MAX_DEVICES_PER_ROOM} dispositivos por habitación")
         
         # Configurar estado inicial según tipo
-        if device_type == "light":
-            state = False if initial_state is None else bool(initial_state)
-        
-        elif device_type == "thermostat":
-            state = self.DEFAULT_TEMP if initial_state is None else int(initial_state)
-            self._validate_temperature(state)
-        
-        elif device_type == "fan":
-            state = self.DEFAULT_FAN_SPEED if initial_state is None else int(initial_state)
-            self._validate_fan_speed(state)
-        
-        elif device_type == "oven":
+        if device_type == "oven":
+            state = self._oven_state(initial_state)
+            self._validate_oven_temp(state["temperature"])
+            self._validate_oven_timer(state["timer"])
+        else:
             if initial_state is None:
-                state = {
-                    "temperature": self.DEFAULT_OVEN_TEMP,
-                    "timer": 0,  # minutos
-                    "active": False
-                }
-            else:
-                state = initial_state
-                if isinstance(state, dict):
-                    self._validate_oven_temp(state.get("temperature", self.DEFAULT_OVEN_TEMP))
-                    self._validate_oven_timer(state.get("timer", 0))
+                initial_state = getattr(self, self._STATE_HANDLERS[device_type][2])
+            state = self._coerce_state(device_type, initial_state)
         
         # Crear dispositivo
         device_id = self._generate_device_id(device_type)
@@ -224,9 +525,9 @@ class DomoticaStorage:
             state=state
         )
         
-        room.devices.append(device_id)
+        self._attach(room, self.devices[device_id])
         
-        self._save_to_file()
+        self._save_to_file(("devices", device_id), ("rooms", room_name), ("counters", None))
         return {
             "device_id": device_id,
             "type": device_type,
@@ -235,6 +536,7 @@ class DomoticaStorage:
             "status": "added"
         }
     
+    @_mutation
     def update_device(
         self,
         device_id: str,
@@ -248,6 +550,25 @@ class DomoticaStorage:
         
         device = self.devices[device_id]
         
+        # Validar el nuevo estado antes de modificar nada: un error no deja
+        # el dispositivo a medio actualizar (ni movido de habitación)
+        new_state = None
+        if state is not None:
+            if device.type in self._STATE_HANDLERS:
+                new_state = self._coerce_state(device.type, state)
+            elif device.type == "oven":
+                if not isinstance(state, dict):
+                    raise ValueError("El estado del horno debe ser un diccionario {temperature, timer, active}")
+                if "temperature" in state:
+                    self._validate_oven_temp(state["temperature"])
+                if "timer" in state:
+                    self._validate_oven_timer(state["timer"])
+                # El estado del horno siempre es un diccionario completo.
+                # Se crea uno nuevo: el actual puede estar compartido por to_dict()
+                new_state = {**device.state, **state}
+        
+        changes = [("devices", device_id)]
+        
         # Cambiar habitación si se especifica
         if room is not None and room != device.room:
             if room not in self.rooms:
@@ -266,33 +587,19 @@ class DomoticaStorage:
             
             # Mover dispositivo
             old_room = self.rooms[device.room]
-            old_room.devices.remove(device_id)
-            new_room.devices.append(device_id)
+            self._detach(old_room, device)
+            self._attach(new_room, device)
             device.room = room
+            changes += [("rooms", old_room.name), ("rooms", room)]
         
         # Cambiar estado si se especifica
-        if state is not None:
-            if device.type == "light":
-                device.state = bool(state)
-            elif device.type == "thermostat":
-                self._validate_temperature(int(state))
-                device.state = int(state)
-            elif device.type == "fan":
-                self._validate_fan_speed(int(state))
-                device.state = int(state)
-            elif device.type == "oven":
-                if isinstance(state, dict):
-                    current_state = device.state if isinstance(device.state, dict) else {}
-                    current_state.update(state)
-                    if "temperature" in state:
-                        self._validate_oven_temp(state["temperature"])
-                    if "timer" in state:
-                        self._validate_oven_timer(state["timer"])
-                    device.state = current_state
-        
-        self._save_to_file()
+        if new_state is not None:
+            device.state = new_state
+        
+        self._save_to_file(*changes)
         return device.to_dict()
     
+    @_mutation
     def delete_device(self, device_id: str) -> dict:
         """Elimina un dispositivo del sistema."""
         self.reload()  # Sincronizar con archivo
@@ -302,26 +609,119 @@ class DomoticaStorage:
         device = self.devices[device_id]
         room = self.rooms[device.room]
         
-        room.devices.remove(device_id)
+        self._detach(room, device)
         del self.devices[device_id]
         
-        self._save_to_file()
+        self._save_to_file(("devices", device_id), ("rooms", room.name))
         return {"device_id": device_id, "status": "deleted"}
     
-    def list_devices(self, room_filter: Optional[str] = None) -> list[dict]:
-        """Lista dispositivos, opcionalmente filtrados por habitación."""
-        self.reload()  # Sincronizar con archivo
-        devices = self.devices.values()
+    @_shared
+    def list_devices(
+        self,
+        room_filter: Optional[str] = None,
+        type_filter: Optional[str] = None
+    ) -> list[dict]:
+        """Lista dispositivos, opcionalmente filtrados por habitación y/o tipo."""
+        return self._aggregate(
+            ("list_devices", room_filter, type_filter),
+            lambda: self._device_dicts(room_filter, type_filter)
+        )
+    
+    def _device_dicts(
+        self,
+        room_filter: Optional[str] = None,
+        type_filter: Optional[str] = None
+    ) -> list[dict]:
+        """Dispositivos serializados sobre los datos ya cargados (sin recargar)."""
+        if room_filter and room_filter not in self.rooms:
+            raise ValueError(f"Habitación '{room_filter}' no existe")
+        
+        if type_filter:
+            rooms = [room_filter] if room_filter else self.rooms
+            return [
+                self.devices[dev_id].to_dict()
+                for room_name in rooms
+                for dev_id in sorted(self._room_type_index.get((room_name, type_filter), ()))
+            ]
         
         if room_filter:
-            if room_filter not in self.rooms:
-                raise ValueError(f"Habitación '{room_filter}' no existe")
-            devices = [d for d in devices if d.room == room_filter]
+            # Room.devices ya es el índice habitación → dispositivos
+            return [self.devices[dev_id].to_dict() for dev_id in self.rooms[room_filter].devices]
+        
+        return [d.to_dict() for d in self.devices.values()]
+    
+    @_shared
+    def get_status(self) -> dict:
+        """Obtiene una instantánea coherente del estado general del sistema."""
+        return {
+            "rooms": self._aggregate(("list_rooms",), self._room_summaries),
+            "devices": self._aggregate(("list_devices", None, None), self._device_dicts),
+            "total_rooms": len(self.rooms),
+            "total_devices": len(self.devices)
+        }
+    
+    @_shared
+    def get_device_info(self, device_id: str) -> dict:
+        """Obtiene información detallada de un dispositivo."""
+        if device_id not in self.devices:
+            raise ValueError(f"Dispositivo '{device_id}' no encontrado")
+        
+        return self.devices[device_id].to_dict()
+    
+    def _aggregate(self, key: tuple, build) -> list[dict]:
+        """Resultado de `build()` reutilizado mientras no cambie la versión de los datos."""
+        hit = self._agg_cache.get(key)
+        if hit is not None and hit[0] == self._version:
+            return list(hit[1])
+        result = build()
+        self._agg_cache[key] = (self._version, tuple(result))
+        return result
+    
+    # ========== LOTES ==========
+    
+    @contextmanager
+    def batch(self) -> Iterator["DomoticaStorage"]:
+        """Agrupa varias modificaciones y las guarda en disco una sola vez al final.
         
-        return [d.to_dict() for d in devices]
+        Mantiene el lock durante todo el lote; los cambios aplicados antes de
+        un error también se guardan, igual que sin lote.
+        """
+        with self._lock.write():
+            self.reload()  # Sincronizar con archivo una vez al inicio
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0 and self._dirty:
+                    self._schedule_flush()
     
     # ========== VALIDACIONES ==========
     
+    # Estados simples por tipo: (conversión, validador, atributo con el valor por defecto).
+    # El horno se trata aparte porque su estado es un diccionario que se combina
+    _STATE_HANDLERS = MappingProxyType({
+        "light": (bool, None, "DEFAULT_LIGHT_STATE"),
+        "thermostat": (int, "_validate_temperature", "DEFAULT_TEMP"),
+        "fan": (int, "_validate_fan_speed", "DEFAULT_FAN_SPEED")
+    })
+    
+    def _coerce_state(self, device_type: str, value) -> bool | int:
+        """Convierte y valida el estado de un dispositivo de estado simple."""
+        coerce, validator, _ = self._STATE_HANDLERS[device_type]
+        state = coerce(value)
+        if validator:
+            getattr(self, validator)(state)
+        return state
+    
+    def _oven_state(self, state: Optional[dict] = None) -> dict:
+        """Estado completo del horno: valores por defecto completados con `state`."""
+        if state is None:
+            return dict(self._OVEN_DEFAULT)
+        if not isinstance(state, dict):
+            raise ValueError("El estado del horno debe ser un diccionario {temperature, timer, active}")
+        return {**self._OVEN_DEFAULT, **state}
+    
     def _validate_temperature(self, temp: int) -> None:
         """Valida que la temperatura esté en rango."""
         if not (self.MIN_TEMP <= temp <= self.MAX_TEMP):
@@ -352,76 +752,428 @@ class DomoticaStorage:
     
     # ========== PERSISTENCIA ==========
     
-    def _save_to_file(self) -> None:
-        """Guarda el estado actual en el archivo JSON."""
-        data = {
-            "rooms": {
-                name: {
-                    "name": room.name,
-                    "type": room.type,
-                    "devices": room.devices
-                }
-                for name, room in self.rooms.items()
-            },
-            "devices": {
-                dev_id: {
-                    "id": device.id,
-                    "type": device.type,
-                    "room": device.room,
-                    "state": device.state
-                }
-                for dev_id, device in self.devices.items()
-            },
-            "counters": self._counters
+    def _save_to_file(self, *changes: tuple[str, Optional[str]]) -> None:
+        """Marca como modificadas las entradas `changes` y programa su escritura.
+        
+        Las modificaciones seguidas se agrupan: se escribe una vez,
+        SAVE_DELAY segundos después de la última (o al llamar a flush()).
+        """
+        self._version += 1
+        self._dirty = True
+        self._changes.update(changes)
+        self._unsaved_sections.update(section for section, _ in changes)
+        if self._batch_depth or self._replaying:
+            # Dentro de un lote: se programa al cerrarlo. Al repetir operaciones
+            # desde flush() se escribe a continuación
+            return
+        self._schedule_flush()
+    
+    def _schedule_flush(self) -> None:
+        """(Re)programa la escritura diferida de los cambios pendientes."""
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+        self._save_timer = threading.Timer(self.SAVE_DELAY, self.flush)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+    
+    @_synchronized
+    def flush(self) -> None:
+        """Escribe en disco los cambios pendientes, si los hay."""
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+            self._save_timer = None
+        if not self._dirty:
+            return
+        # Comprobar y escribir sin que otro proceso pueda escribir en medio
+        with self._file_lock.exclusive():
+            if self._stat_file() != self._file_stamp:
+                self._merge_from_disk()
+            if self._file_stamp is None or self._journal_entries >= self.CHECKPOINT_EVERY:
+                self._write_file()
+            else:
+                self._append_journal()
+        self._changes.clear()
+        self._ops.clear()
+        self._dirty = False
+    
+    def _merge_from_disk(self) -> None:
+        """Recarga lo que escribió otro proceso y repite encima los cambios propios.
+        
+        Cada operación vuelve a validarse con los datos actuales; la que ya no es
+        posible (p. ej. la habitación se eliminó) se descarta con un aviso.
+        """
+        stamp = self._stat_file()
+        if stamp is None:
+            # Los archivos desaparecieron: se reescriben desde memoria
+            self._file_stamp = None
+            return
+        ops = self._ops
+        self._load_from_file(stamp)
+        self._file_stamp = stamp
+        self._version += 1
+        self._changes.clear()
+        self._ops = []
+        self._replaying = True
+        try:
+            for name, args, kwargs in ops:
+                try:
+                    getattr(self, name)(*args, **kwargs)
+                except ValueError as e:
+                    logger.warning("Cambio descartado al combinar con otro proceso: %s%r: %s", name, args, e)
+        finally:
+            self._replaying = False
+    
+    def _write_file(self) -> None:
+        """Vuelca el estado completo de las secciones modificadas y vacía el diario."""
+        # Sin volcado previo (primer guardado) se escriben todas
+        previous = self._file_stamp
+        sections = self._SECTIONS if previous is None else self._unsaved_sections
+        stamp = list(previous[:-1]) if previous else [self._MISSING] * len(self._SECTIONS)
+        # Primero lo referenciado: contadores, dispositivos y por último habitaciones
+        for section in ("counters", "devices", "rooms"):
+            if section in sections:
+                stamp[self._SECTIONS.index(section)] = self._write_section(section)
+        
+        # Los archivos ya incluyen todo lo del diario. Si se interrumpe antes de
+        # borrarlo, volver a aplicarlo al cargar no cambia nada
+        try:
+            os.remove(self._JOURNAL_PATH)
+        except FileNotFoundError:
+            pass
+        self._journal_entries = 0
+        self._unsaved_sections.clear()
+        
+        # Nuestra propia escritura no requiere volver a parsear los archivos. La
+        # huella sale de lo que escribimos, no de un stat posterior: no debe
+        # cubrir nada que haya escrito otro proceso sin que lo hayamos leído
+        self._file_stamp = (*stamp, self._MISSING)
+    
+    def _write_section(self, section: str) -> tuple[int, int]:
+        """Serializa una sección en su archivo JSON; devuelve la huella del archivo escrito."""
+        if section == "rooms":
+            payload = {name: room.to_json_dict() for name, room in self.rooms.items()}
+        elif section == "devices":
+            # to_dict() del dispositivo ya tiene la forma persistida y está cacheado
+            payload = {dev_id: device.to_dict() for dev_id, device in self.devices.items()}
+        else:
+            # Copia: los contadores en memoria se incrementan in situ
+            payload = dict(self._counters)
+        
+        # orjson serializa directamente a bytes UTF-8: una sola escritura binaria.
+        # Se escribe a un temporal y se renombra: los lectores de otros procesos
+        # nunca ven el archivo truncado o a medio escribir. El temporal tiene nombre
+        # único para que dos escritores no se pisen el mismo archivo
+        path = self._STORAGE_PATHS[section]
+        tmp_path = f"{path}.{os.getpid()}-{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+                f.flush()
+                os.fsync(f.fileno())
+                # El renombrado conserva mtime y tamaño
+                stat = os.fstat(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        file_stamp = (stat.st_mtime_ns, stat.st_size)
+        self._section_data[section] = (file_stamp, payload)
+        return file_stamp
+    
+    def _append_journal(self) -> None:
+        """Añade al diario una línea con el valor actual de las entradas modificadas."""
+        delta: dict = {}
+        for section, key in self._changes:
+            if section == "counters":
+                delta["counters"] = self._counters
+                continue
+            item = getattr(self, section).get(key)
+            # null marca una entrada eliminada (o renombrada)
+            value = None
+            if item is not None:
+                value = item.to_json_dict() if section == "rooms" else item.to_dict()
+            delta.setdefault(section, {})[key] = value
+        
+        # Una sola escritura en modo append: las líneas cortas no se intercalan
+        line = orjson.dumps(delta) + b"\n"
+        with open(self._JOURNAL_PATH, 'ab') as f:
+            # flush() ya comprobó la huella, pero si el diario no mide lo que
+            # leímos hay líneas ajenas sin aplicar: sellarlas como propias las
+            # perdería en el siguiente volcado, así que se deja la huella antigua
+            # (distinta de la real) para que la próxima recarga las lea
+            consumed = os.fstat(f.fileno()).st_size == self._file_stamp[3][1]
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            stat = os.fstat(f.fileno())
+        self._journal_entries += 1
+        if consumed:
+            self._file_stamp = (*self._file_stamp[:3], (stat.st_mtime_ns, stat.st_size))
+    
+    def _load_from_file(self, stamp: tuple[tuple[int, int], ...]) -> None:
+        """Carga el estado desde los archivos de sección y le aplica el diario de cambios.
+        
+        Solo se vuelven a parsear los archivos cuya huella cambió desde la última
+        lectura. Si alguno no se puede leer o no es JSON válido, el error se propaga
+        sin modificar el estado en memoria (no se sobrescribe con datos vacíos).
+        """
+        data = {}
+        for section, file_stamp in zip(self._SECTIONS, stamp):
+            cached = self._section_data.get(section)
+            if cached is None or cached[0] != file_stamp:
+                content = {}
+                if file_stamp != self._MISSING:
+                    content = self._read_json(self.STORAGE_FILES[section])
+                cached = self._section_data[section] = (file_stamp, content)
+            # Copia superficial: el diario se aplica sin alterar la lectura guardada
+            data[section] = dict(cached[1])
+        journal_entries, journal_sections = self._replay_journal(data)
+        
+        self._apply_data(data)
+        self._journal_entries = journal_entries
+        self._unsaved_sections = journal_sections
+    
+    def _read_json(self, path: Path) -> dict:
+        """Parsea un archivo JSON; registra y propaga los errores de lectura."""
+        try:
+            # orjson parsea directamente desde la proyección en memoria, sin copiar
+            # el archivo a un bytes intermedio. La proyección se cierra enseguida
+            # para no bloquear el os.replace() de la siguiente escritura
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as view:
+                        return orjson.loads(view)
+        except (OSError, ValueError) as e:
+            # ValueError: archivo vacío (no se puede proyectar) o JSON inválido
+            logger.warning("Error cargando datos de %s: %s", path, e)
+            raise
+    
+    def _apply_data(self, data: dict) -> None:
+        """Sustituye el estado en memoria por el de `data` (formato del archivo)."""
+        # Restaurar habitaciones
+        rooms = {
+            name: Room(
+                name=room_data["name"],
+                type=room_data["type"],
+                devices=dict.fromkeys(room_data["devices"])
+            )
+            for name, room_data in data.get("rooms", {}).items()
+        }
+        
+        # Restaurar dispositivos
+        devices = {
+            dev_id: Device(
+                id=device_data["id"],
+                type=device_data["type"],
+                room=device_data["room"],
+                state=self._loaded_state(device_data)
+            )
+            for dev_id, device_data in data.get("devices", {}).items()
         }
+        self._reconcile(rooms, devices)
+        
+        # Recalcular recuentos por tipo e índice (datos derivados, no se persisten)
+        room_type_index = defaultdict(set)
+        room_type_counts = defaultdict(int)
+        for room in rooms.values():
+            room_type_counts[room.type] += 1
+            for dev_id in room.devices:
+                dev_type = devices[dev_id].type
+                room.type_counts[dev_type] = room.type_counts.get(dev_type, 0) + 1
+                room_type_index[(room.name, dev_type)].add(dev_id)
+        
+        # Sustituir el estado solo cuando todo se ha cargado correctamente
+        self.rooms = rooms
+        self.devices = devices
+        self._room_type_index = room_type_index
+        self._room_type_counts = room_type_counts
+        
+        # Restaurar contadores
+        self._counters = data.get("counters") or dict(self._DEFAULT_COUNTERS)
+    
+    def _reconcile(self, rooms: dict[str, Room], devices: dict[str, Device]) -> None:
+        """Hace coherentes las listas de las habitaciones con la habitación de cada dispositivo.
         
-        with open(self.STORAGE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        Las secciones se guardan en archivos distintos: si llegan desacompasadas
+        (p. ej. un archivo editado a mano) se corrige en memoria en lugar de fallar.
+        """
+        for room in rooms.values():
+            stale = [
+                dev_id for dev_id in room.devices
+                if dev_id not in devices or devices[dev_id].room != room.name
+            ]
+            for dev_id in stale:
+                del room.devices[dev_id]
+        for dev_id, device in list(devices.items()):
+            room = rooms.get(device.room)
+            if room is None:
+                logger.warning("Dispositivo '%s' en habitación inexistente '%s', se ignora", dev_id, device.room)
+                del devices[dev_id]
+            elif dev_id not in room.devices:
+                room.devices[dev_id] = None
     
-    def _load_from_file(self) -> None:
-        """Carga el estado desde el archivo JSON."""
+    def _replay_journal(self, data: dict) -> tuple[int, set[str]]:
+        """Aplica sobre `data` las líneas del diario.
+        
+        Devuelve cuántas líneas había y qué secciones modifican.
+        """
         try:
-            with open(self.STORAGE_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Restaurar habitaciones
-            self.rooms = {
-                name: Room(
-                    name=room_data["name"],
-                    type=room_data["type"],
-                    devices=room_data["devices"]
-                )
-                for name, room_data in data.get("rooms", {}).items()
-            }
-            
-            # Restaurar dispositivos
-            self.devices = {
-                dev_id: Device(
-                    id=device_data["id"],
-                    type=device_data["type"],
-                    room=device_data["room"],
-                    state=device_data["state"]
-                )
-                for dev_id, device_data in data.get("devices", {}).items()
-            }
-            
-            # Restaurar contadores
-            self._counters = data.get("counters", {
-                "light": 1,
-                "thermo": 1,
-                "fan": 1,
-                "oven": 1
-            })
-            
-        except Exception as e:
-            print(f"⚠️  Error cargando datos: {e}")
-            print("   Iniciando con datos limpios")
+            with open(self._JOURNAL_PATH, 'rb') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return 0, set()
+        
+        count = len(lines)
+        sections = set()
+        for line in lines:
+            try:
+                delta = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # Línea a medio escribir (p. ej. por un corte de luz): se ignora y
+                # se fuerza un volcado completo, para no añadir detrás de ella
+                logger.warning("Línea inválida en %s, se ignora", self.JOURNAL_FILE)
+                count = max(count, self.CHECKPOINT_EVERY)
+                continue
+            sections.update(delta)
+            for section in ("rooms", "devices"):
+                entries = data.setdefault(section, {})
+                for key, value in delta.get(section, {}).items():
+                    if value is None:
+                        entries.pop(key, None)
+                    else:
+                        entries[key] = value
+            if "counters" in delta:
+                data["counters"] = delta["counters"]
+        return count, sections
+    
+    def _loaded_state(self, device_data: dict):
+        """Estado leído del archivo; un horno con estado no válido vuelve al de por defecto."""
+        state = device_data["state"]
+        if device_data["type"] == "oven":
+            return self._oven_state(state if isinstance(state, dict) else None)
+        return state
+    
+    def _stat_file(self) -> Optional[tuple[tuple[int, int], ...]]:
+        """Obtiene la huella de cada archivo de sección y del diario.
+        
+        None si no hay datos guardados (falta el archivo de habitaciones).
+        """
+        stamp = (
+            self._stat_path(self._STORAGE_PATHS["rooms"]),
+            self._stat_path(self._STORAGE_PATHS["devices"]),
+            self._stat_path(self._STORAGE_PATHS["counters"]),
+            self._stat_path(self._JOURNAL_PATH)
+        )
+        if stamp[0] == self._MISSING:
+            return None
+        return stamp
+    
+    def _stat_path(self, path: str) -> tuple[int, int]:
+        """Huella (mtime en ns, tamaño) de un archivo, o _MISSING si no existe."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return self._MISSING
+        return (stat.st_mtime_ns, stat.st_size)
     
     def reload(self) -> None:
-        """Recarga los datos desde el archivo (para sincronizar entre procesos)."""
-        if self.STORAGE_FILE.exists():
-            self._load_from_file()
+        """Recarga los datos desde el archivo (para sincronizar entre procesos).
+        
+        Solo vuelve a parsear el archivo si cambió desde la última carga o guardado.
+        La comprobación se hace sin lock; solo una recarga real toma el exclusivo,
+        junto con el lock compartido de archivo: ningún proceso escribe a mitad de
+        la lectura, así las tres secciones y el diario forman una instantánea coherente.
+        """
+        if not self._needs_reload():
+            return
+        with self._lock.write(), self._file_lock.shared():
+            stamp = self._needs_reload()
+            if stamp:
+                self._load_from_file(stamp)
+                self._file_stamp = stamp
+                self._version += 1
+    
+    def _needs_reload(self) -> Optional[tuple[tuple[int, int], ...]]:
+        """Huella nueva del archivo si hay que recargarlo, o None."""
+        if self._batch_depth or self._dirty:
+            # Hay cambios que aún no están en disco: no descartarlos
+            return None
+        stamp = self._stat_file()
+        if stamp is None or stamp == self._file_stamp:
+            return None
+        return stamp
+    
+    def cached(self, fn):
+        """Decorador que memoiza `fn` por argumentos hasta que cambien los datos."""
+        cache: dict = {}
+        cache_version = -1
+        
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            nonlocal cache_version
+            self.reload()  # Detectar cambios hechos por otros procesos
+            version = self._version
+            if cache_version != version:
+                cache.clear()
+                cache_version = version
+            key = (args, tuple(sorted(kwargs.items())))
+            if key in cache:
+                return cache[key]
+            result = fn(*args, **kwargs)
+            # Si los datos cambiaron durante `fn`, el resultado puede ser de la
+            # versión anterior: se devuelve pero no se guarda
+            if self._version == version == cache_version:
+                cache[key] = result
+            return result
+        return wrapper
+    
+    @property
+    def etag(self) -> str:
+        """ETag que identifica la versión actual de los datos persistidos."""
+        stamp = self._file_stamp or ()
+        return '"' + "-".join(f"{n:x}" for pair in stamp for n in pair) + '"'
+    
+    @contextmanager
+    def snapshot(self) -> Iterator[str]:
+        """Recarga una sola vez y fija los datos mientras dura el bloque.
+        
+        Devuelve el ETag de esa versión; las lecturas dentro del bloque no
+        vuelven a recargar, así que responden exactamente a ese ETag.
+        """
+        self.reload()
+        with self._lock.read():
+            yield self.etag
+
+
+# Instancia global, creada al primer uso: importar el módulo no toca el disco
+_storage: Optional[DomoticaStorage] = None
+_storage_lock = threading.Lock()
 
 
-# Instancia global
-storage = DomoticaStorage()
+def get_storage() -> DomoticaStorage:
+    """Devuelve la instancia compartida de DomoticaStorage, creándola si hace falta."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = DomoticaStorage()
+    return _storage
+
+
+def cached(fn):
+    """Como DomoticaStorage.cached, sobre la instancia de get_storage().
+    
+    Se puede aplicar al importar un módulo: la instancia se obtiene en la primera llamada.
+    """
+    wrapper = None
+    
+    @wraps(fn)
+    def lazy(*args, **kwargs):
+        nonlocal wrapper
+        if wrapper is None:
+            wrapper = get_storage().cached(fn)
+        return wrapper(*args, **kwargs)
+    return lazy